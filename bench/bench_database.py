@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+import sqlite3
+import asyncio
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import database
+
+CALLS = int(os.getenv("BENCH_CALLS", "2000"))
+
+
+def legacy_register_user(user_id, username=None, first_name=None, last_name=None):
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
+        VALUES (?, ?, ?, ?)
+    """, (user_id, username, first_name, last_name))
+    conn.commit()
+    conn.close()
+
+
+def legacy_get_today_downloads_count(user_id):
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT COUNT(*) as cnt FROM downloads
+        WHERE user_id = ? AND status = 'success'
+        AND date(created_at) = date('now')
+    """, (user_id,))
+    result = cursor.fetchone()
+    conn.close()
+    return result["cnt"] if result else 0
+
+
+def prepare(path, journal_mode):
+    database.DB_PATH = path
+    # Without the in-memory daily counters so the today-count rows still time SQLite.
+    database.init_db(cache_daily_counts=False)
+    database.close_connection()
+    conn = sqlite3.connect(path)
+    conn.execute(f"PRAGMA journal_mode={journal_mode}")
+    conn.close()
+
+
+def report(label, started):
+    per_call = (time.perf_counter() - started) / CALLS * 1_000_000
+    print(f"{label:<44} {per_call:10.1f} us/call")
+
+
+def bench_sync(label, func, writes):
+    started = time.perf_counter()
+    for i in range(CALLS):
+        if writes:
+            func(i, "user", "first", "last")
+        else:
+            func(i % 100)
+    report(label, started)
+
+
+async def bench_async(label, func, writes):
+    started = time.perf_counter()
+    for i in range(CALLS):
+        if writes:
+            await database.run_db(func, i, "user", "first", "last")
+        else:
+            await database.run_db(func, i % 100)
+    report(label, started)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{CALLS} calls per case\n")
+
+        prepare(os.path.join(tmp, "legacy.db"), "DELETE")
+        bench_sync("before: connect per call, register_user", legacy_register_user, True)
+        bench_sync("before: connect per call, today count", legacy_get_today_downloads_count, False)
+
+        prepare(os.path.join(tmp, "pooled.db"), "WAL")
+        bench_sync("after: pooled WAL, register_user", database.register_user, True)
+        bench_sync("after: pooled WAL, today count", database.get_today_downloads_count, False)
+
+        prepare(os.path.join(tmp, "async.db"), "WAL")
+        asyncio.run(bench_async("after: run_db on db thread, register_user", database.register_user, True))
+        asyncio.run(bench_async("after: run_db on db thread, today count", database.get_today_downloads_count, False))
+
+        database.close_db()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+import functools
+import http.server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import yt_dlp
+import downloader
+
+CALLS = int(os.getenv("BENCH_CALLS", "50"))
+CLIP_SIZE = int(os.getenv("BENCH_CLIP_KB", "256")) * 1024
+
+
+class KeepAliveHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+
+class QuietServer(http.server.ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        pass
+
+
+def serve(directory):
+    handler = functools.partial(KeepAliveHandler, directory=directory)
+    server = QuietServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def account_for(platform):
+    return 0 if platform == "instagram" and downloader.INSTAGRAM_SESSION_IDS else None
+
+
+def legacy_opts(platform):
+    opts = downloader._get_base_opts()
+    opts["outtmpl"] = os.path.join(downloader.VIDEOS_DIR, "%(id)s.%(ext)s")
+    opts.update(downloader._get_platform_opts(platform, account_for(platform)))
+    opts["noprogress"] = True
+    return opts
+
+
+def fetch(ydl, url):
+    info = ydl.extract_info(url, download=False)
+    info = ydl.process_ie_result(info, download=True)
+    os.remove(ydl.prepare_filename(info))
+
+
+def legacy_setup(platform, url):
+    # Cookie file forgotten so every call rewrites it, like the per-job code did.
+    downloader._instagram_cookie_files.clear()
+    with yt_dlp.YoutubeDL(legacy_opts(platform)) as ydl:
+        for ie_name in downloader.PLATFORM_EXTRACTORS[platform]:
+            ydl.get_info_extractor(ie_name)
+
+
+def pooled_setup(platform, url):
+    with downloader._pooled_ydl(platform, [lambda d: None], {"noprogress": True}, account_for(platform)):
+        pass
+
+
+def legacy_job(platform, url):
+    downloader._instagram_cookie_files.clear()
+    with yt_dlp.YoutubeDL(legacy_opts(platform)) as ydl:
+        fetch(ydl, url)
+
+
+def pooled_job(platform, url):
+    with downloader._pooled_ydl(platform, [lambda d: None], {"noprogress": True}, account_for(platform)) as ydl:
+        fetch(ydl, url)
+
+
+def bench(label, func, platform, url):
+    started = time.perf_counter()
+    for _ in range(CALLS):
+        func(platform, url)
+    per_call = (time.perf_counter() - started) / CALLS * 1000
+    print(f"{label:<44} {per_call:10.2f} ms/call")
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        downloader.VIDEOS_DIR = os.path.join(tmp, "videos")
+        downloader.ensure_videos_dir()
+        with open(os.path.join(tmp, "clip.mp4"), "wb") as f:
+            f.write(os.urandom(CLIP_SIZE))
+        server = serve(tmp)
+        url = f"http://127.0.0.1:{server.server_port}/clip.mp4"
+        print(f"{CALLS} calls per case, {CLIP_SIZE // 1024} KiB clip")
+        if not downloader.INSTAGRAM_SESSION_IDS:
+            print("INSTAGRAM_SESSION_IDS not set: instagram cases skip the cookie file")
+        print()
+
+        for platform in ("youtube", "instagram"):
+            bench(f"before: new YoutubeDL, {platform} setup", legacy_setup, platform, url)
+            bench(f"after: pooled YoutubeDL, {platform} setup", pooled_setup, platform, url)
+        bench("before: new YoutubeDL, full job", legacy_job, "instagram", url)
+        bench("after: pooled YoutubeDL, full job", pooled_job, "instagram", url)
+        print(f"\npool: {downloader.ydl_pool_stats}")
+
+        downloader.close_ydl_pool()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
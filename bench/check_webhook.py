@@ -0,0 +1,87 @@
+import os
+import sys
+import json
+import socket
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import aiohttp
+import webhook
+
+SECRET = "stand-in-secret"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_update(update_id):
+    return json.dumps({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Test"},
+            "text": f"update {update_id}",
+        },
+    })
+
+
+async def post(session, url, body, secret=None):
+    headers = {"Content-Type": "application/json"}
+    if secret is not None:
+        headers[webhook.SECRET_HEADER] = secret
+    async with session.post(url, data=body, headers=headers) as resp:
+        return resp.status
+
+
+def check(label, got, expected):
+    print(f"{label:<44} {got}")
+    if got != expected:
+        raise SystemExit(f"FAIL: {label}: expected {expected}, got {got}")
+
+
+async def main():
+    # One worker and a one-slot queue: the first update is held by the blocked worker,
+    # the second waits in the queue, the third must be refused with 503.
+    webhook.WEBHOOK_HOST = "127.0.0.1"
+    webhook.WEBHOOK_PORT = free_port()
+    webhook.WEBHOOK_WORKERS = 1
+    webhook.WEBHOOK_QUEUE_SIZE = 1
+
+    delivered = []
+    release = asyncio.Event()
+
+    async def process_new_updates(updates):
+        await release.wait()
+        delivered.extend(update.update_id for update in updates)
+
+    server = await webhook.start_webhook_server(process_new_updates, SECRET)
+    url = f"http://{webhook.WEBHOOK_HOST}:{webhook.WEBHOOK_PORT}{webhook.WEBHOOK_PATH}"
+    try:
+        async with aiohttp.ClientSession() as session:
+            check("unsigned update", await post(session, url, make_update(1)), 403)
+            check("wrong secret", await post(session, url, make_update(1), "nope"), 403)
+            check("signed, malformed body", await post(session, url, "{", SECRET), 400)
+            check("signed update 1", await post(session, url, make_update(1), SECRET), 200)
+            await asyncio.sleep(0.1)
+            check("signed update 2", await post(session, url, make_update(2), SECRET), 200)
+            check("signed update 3, queue full", await post(session, url, make_update(3), SECRET), 503)
+
+            release.set()
+            await asyncio.wait_for(server["queue"].join(), 5)
+            check("redelivered update 3", await post(session, url, make_update(3), SECRET), 200)
+            await asyncio.wait_for(server["queue"].join(), 5)
+    finally:
+        await webhook.stop_webhook_server(server)
+
+    check("handed to process_new_updates", sorted(delivered), [1, 2, 3])
+    print(f"\nwebhook: {webhook.get_webhook_stats()}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
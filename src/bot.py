@@ -1,21 +1,61 @@
 import os
+import time
+import socket
+import secrets
+from contextlib import nullcontext
 import asyncio
 import logging
 from telebot.async_telebot import AsyncTeleBot
-from telebot import apihelper, types
+from telebot import types
+from telebot.asyncio_helper import ApiTelegramException
 from dotenv import load_dotenv
 
-from database import init_db, register_user, log_download, update_download_status, get_user_stats, get_today_downloads_count
+load_dotenv()
+
+from database import (
+    init_db, register_user, log_download, update_download_status, get_user_stats, get_today_downloads_count,
+    get_cached_video, save_cached_video, invalidate_cached_video, get_video_cache_stats, run_db,
+    run_db_fresh, start_write_behind, stop_write_behind, enqueue_download_job, count_queued_jobs,
+    lease_download_job, extend_job_lease, release_download_job, release_all_leases, complete_download_job,
+    save_description, pop_description, JOB_LEASE_TIMEOUT, get_negative_result, save_negative_result,
+    get_pending_job_positions, is_daily_count_cached
+)
 from downloader import (
-    extract_url, detect_platform, detect_video_type, download_video,
-    cleanup_file, MAX_FILE_SIZE, get_progress_text, active_progress,
-    store_description, get_description
+    extract_url, detect_platform, download_video,
+    cleanup_file, MAX_FILE_SIZE, MAX_FILE_SIZE_MB, get_progress_text, get_progress,
+    create_progress_job, finish_progress_job,
+    COMPRESSED_SUFFIX, get_video_parts, get_error_class, NEGATIVE_CACHE_TTL, DOWNLOAD_WORKERS, DOWNLOAD_QUEUE_SIZE,
+    DOWNLOAD_PROCESSES, warm_ydl_pool, close_ydl_pool, get_instagram_sessions, PLATFORM_CONCURRENCY,
+    format_queue_position, get_download_queue_stats, PLATFORM_NAMES
+)
+from canonical import resolve_url, get_resolve_stats
+from throttle import schedule, get_retry_after, rewind_files, get_throttle_stats
+from proxy_pool import (
+    get_proxy_chain, select_routes, get_routes_to_probe, use_route, record_success, record_failure,
+    get_route_stats, install_route_sessions, is_local_api
+)
+from webhook import (
+    is_webhook_enabled, get_webhook_url, start_webhook_server, stop_webhook_server, get_webhook_stats,
+    WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS
 )
-
-load_dotenv()
 
 ADMIN_IDS = {1499566021, 450638724}
 DAILY_LIMIT = 10
+COMPRESS_OVERSIZED = os.getenv("COMPRESS_OVERSIZED", "0") == "1"
+SPLIT_OVERSIZED = os.getenv("SPLIT_OVERSIZED", "0") == "1"
+
+PROGRESS_TICK = 0.5
+PROGRESS_EDITS_PER_SECOND = float(os.getenv("PROGRESS_EDITS_PER_SECOND", "10"))
+PROGRESS_CHAT_INTERVAL = float(os.getenv("PROGRESS_CHAT_INTERVAL", "3"))
+PROGRESS_MIN_STEP = float(os.getenv("PROGRESS_MIN_STEP", "5"))
+PROGRESS_FINAL_ATTEMPTS = 3
+PROGRESS_CHAT_EDITS_LIMIT = 1000
+
+BOT_MODE = os.getenv("BOT_MODE", "all")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", str(sum(PLATFORM_CONCURRENCY.values()))))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
 
 logging.basicConfig(
     level=logging.INFO,
@@ -24,115 +64,66 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
-SOCKS5_HOST = os.getenv("SOCKS5_HOST", "")
-SOCKS5_PORT = os.getenv("SOCKS5_PORT", "")
-SOCKS5_USERNAME = os.getenv("SOCKS5_USERNAME", "")
-SOCKS5_PASSWORD = os.getenv("SOCKS5_PASSWORD", "")
-MTPROTO_HOST = os.getenv("MTPROTO_HOST", "")
-MTPROTO_PORT = os.getenv("MTPROTO_PORT", "")
-MTPROTO_SECRET = os.getenv("MTPROTO_SECRET", "")
-
-PROXY_MODE_SOCKS5 = "socks5"
-PROXY_MODE_MTPROTO = "mtproto"
-PROXY_MODE_DIRECT = "direct"
-
-current_proxy_mode = None
-
-
-def build_socks5_proxy():
-    if not SOCKS5_HOST or not SOCKS5_PORT:
-        return None
-    if SOCKS5_USERNAME and SOCKS5_PASSWORD:
-        return f"socks5://{SOCKS5_USERNAME}:{SOCKS5_PASSWORD}@{SOCKS5_HOST}:{SOCKS5_PORT}"
-    return f"socks5://{SOCKS5_HOST}:{SOCKS5_PORT}"
+ROUTE_PROBE_INTERVAL = float(os.getenv("ROUTE_PROBE_INTERVAL", "10"))
 
 
-def build_mtproto_proxy():
-    if not MTPROTO_HOST or not MTPROTO_PORT:
-        return None
-    if MTPROTO_SECRET:
-        return f"https://{MTPROTO_HOST}:{MTPROTO_PORT}/{MTPROTO_SECRET}"
-    return f"https://{MTPROTO_HOST}:{MTPROTO_PORT}"
-
-
-def set_proxy(mode):
-    global current_proxy_mode
-    if mode == PROXY_MODE_SOCKS5:
-        proxy_url = build_socks5_proxy()
-        if proxy_url:
-            apihelper.proxy = {"https": proxy_url, "http": proxy_url}
-            current_proxy_mode = PROXY_MODE_SOCKS5
-            logger.info("Proxy: SOCKS5")
-            return True
-    elif mode == PROXY_MODE_MTPROTO:
-        proxy_url = build_mtproto_proxy()
-        if proxy_url:
-            apihelper.proxy = {"https": proxy_url, "http": proxy_url}
-            current_proxy_mode = PROXY_MODE_MTPROTO
-            logger.info("Proxy: MTProto")
-            return True
-    elif mode == PROXY_MODE_DIRECT:
-        apihelper.proxy = None
-        current_proxy_mode = PROXY_MODE_DIRECT
-        logger.info("Proxy: Direct")
-        return True
-    return False
-
-
-def get_proxy_chain():
-    chain = []
-    if build_socks5_proxy():
-        chain.append(PROXY_MODE_SOCKS5)
-    if build_mtproto_proxy():
-        chain.append(PROXY_MODE_MTPROTO)
-    chain.append(PROXY_MODE_DIRECT)
-    return chain
-
-
-async def test_connection(bot_instance):
+async def test_connection(bot_instance, mode):
+    started = time.monotonic()
     try:
-        await bot_instance.get_me()
-        return True
+        with use_route(mode):
+            await bot_instance.get_me()
     except Exception as e:
-        logger.warning(f"Connection test failed ({current_proxy_mode}): {e}")
+        record_failure(mode)
+        logger.warning(f"Connection test failed ({mode}): {e}")
         return False
+    record_success(mode, time.monotonic() - started)
+    return True
 
 
 async def connect_with_fallback(bot_instance):
     chain = get_proxy_chain()
     logger.info(f"Proxy chain: {' -> '.join(chain)}")
-    for mode in chain:
-        if set_proxy(mode):
-            if await test_connection(bot_instance):
-                logger.info(f"Connected: {mode}")
-                return mode
-            logger.warning(f"Failed: {mode}")
+    for mode in select_routes():
+        if await test_connection(bot_instance, mode):
+            logger.info(f"Connected: {mode}")
+            return mode
+        logger.warning(f"Failed: {mode}")
     logger.error("All connection methods failed")
     return None
 
 
 async def send_with_fallback(func, *args, **kwargs):
-    chain = get_proxy_chain()
-    current_idx = 0
-    if current_proxy_mode in chain:
-        current_idx = chain.index(current_proxy_mode)
-    ordered_chain = chain[current_idx:] + chain[:current_idx]
-
     last_error = None
-    for mode in ordered_chain:
+    for attempt, mode in enumerate(select_routes()):
+        if attempt:
+            rewind_files(args, kwargs)
+        started = time.monotonic()
         try:
-            set_proxy(mode)
-            return await func(*args, **kwargs)
+            with use_route(mode):
+                result = await func(*args, **kwargs)
+        except ApiTelegramException:
+            # Telegram answered, so the route itself is fine.
+            record_success(mode, time.monotonic() - started)
+            raise
         except Exception as e:
+            record_failure(mode)
             last_error = e
             logger.warning(f"Send failed via {mode}: {e}")
             continue
+        record_success(mode, time.monotonic() - started)
+        return result
     if last_error:
         raise last_error
 
 
+async def run_route_prober():
+    while True:
+        await asyncio.sleep(ROUTE_PROBE_INTERVAL)
+        for mode in get_routes_to_probe():
+            await test_connection(bot, mode)
+
+
 bot = AsyncTeleBot(TOKEN)
-init_db()
 
 
 def get_main_keyboard():
@@ -144,42 +135,180 @@ def get_main_keyboard():
     return markup
 
 
+def get_description_keyboard(description):
+    desc_key = secrets.token_hex(8)
+    save_description(desc_key, description.strip() if description and description.strip() else "", deferred=True)
+    inline_kb = types.InlineKeyboardMarkup()
+    inline_kb.add(types.InlineKeyboardButton("📝 Получить описание", callback_data=f"desc_{desc_key}"))
+    return inline_kb
+
+
 async def safe_send_message(chat_id, text, **kwargs):
-    return await send_with_fallback(bot.send_message, chat_id, text, **kwargs)
+    return await schedule("message", chat_id, send_with_fallback, bot.send_message, chat_id, text, **kwargs)
+
+
+async def safe_send_video(chat_id, video, **kwargs):
+    return await schedule("upload", chat_id, send_with_fallback, bot.send_video, chat_id, video, **kwargs)
 
 
-async def safe_edit_message(text, chat_id, message_id, **kwargs):
+async def safe_delete_message(chat_id, message_id):
     try:
-        return await send_with_fallback(bot.edit_message_text, text, chat_id, message_id, **kwargs)
+        await schedule("message", chat_id, send_with_fallback, bot.delete_message, chat_id, message_id)
     except Exception:
         pass
 
 
-async def safe_send_video(chat_id, video, **kwargs):
-    return await send_with_fallback(bot.send_video, chat_id, video, **kwargs)
+async def safe_answer_callback(call_id, **kwargs):
+    try:
+        await schedule("message", None, send_with_fallback, bot.answer_callback_query, call_id, **kwargs)
+    except Exception:
+        pass
 
 
-async def safe_delete_message(chat_id, message_id):
+async def safe_remove_reply_markup(chat_id, message_id):
     try:
-        await send_with_fallback(bot.delete_message, chat_id, message_id)
+        await schedule(
+            "message", chat_id, send_with_fallback, bot.edit_message_reply_markup,
+            chat_id, message_id, reply_markup=None
+        )
     except Exception:
         pass
 
 
-async def update_progress(chat_id, message_id, user_id, platform, done_event):
-    last_text = ""
-    while not done_event.is_set():
-        text = get_progress_text(user_id, platform)
-        if text and text != last_text:
-            await safe_edit_message(text, chat_id, message_id)
-            last_text = text
-        await asyncio.sleep(2)
+def open_video(path):
+    # A local Bot API server reads the file itself, so only the path crosses the wire.
+    if is_local_api():
+        return nullcontext(f"file://{os.path.abspath(path)}")
+    return open(path, "rb")
+
+
+async def send_video_parts(chat_id, parts, description):
+    for i, part in enumerate(parts):
+        is_last = i == len(parts) - 1
+        with open_video(part) as video_file:
+            await safe_send_video(
+                chat_id, video_file,
+                caption=f"Часть {i + 1}/{len(parts)}",
+                supports_streaming=True,
+                reply_markup=get_description_keyboard(description) if is_last else None
+            )
+
+
+progress_messages = {}
+progress_chat_edits = {}
+progress_scheduler = {"task": None, "tokens": PROGRESS_EDITS_PER_SECOND, "blocked_until": 0.0}
+
+
+async def edit_progress_message(chat_id, message_id, text):
+    try:
+        await schedule("edit", chat_id, send_with_fallback, bot.edit_message_text, text, chat_id, message_id)
+    except Exception as e:
+        retry_after = get_retry_after(e)
+        if retry_after:
+            progress_scheduler["blocked_until"] = max(
+                progress_scheduler["blocked_until"], time.monotonic() + retry_after
+            )
+            logger.warning(f"Progress edits paused for {retry_after}s (429)")
+            return False
+    now = time.monotonic()
+    if len(progress_chat_edits) >= PROGRESS_CHAT_EDITS_LIMIT:
+        _evict_idle_chat_edits(now)
+    progress_chat_edits[chat_id] = now
+    return True
+
+
+def _evict_idle_chat_edits(now):
+    # Past the interval an entry no longer delays anything, so dropping it changes no pacing.
+    idle = [chat_id for chat_id, edited in progress_chat_edits.items() if now - edited >= PROGRESS_CHAT_INTERVAL]
+    for chat_id in idle:
+        del progress_chat_edits[chat_id]
+
+
+def _get_due_progress(entry, now):
+    text = get_progress_text(entry["job_id"])
+    if not text or text == entry["last_text"]:
+        return None
+    if now - progress_chat_edits.get(entry["chat_id"], 0) < PROGRESS_CHAT_INTERVAL:
+        return None
+    p = get_progress(entry["job_id"])
+    status = p["status"] if p else None
+    percent = p["percent"] if p else None
+    if (
+        status == "downloading" and entry["last_status"] == "downloading"
+        and abs(percent - entry["last_percent"]) < PROGRESS_MIN_STEP
+    ):
+        return None
+    return text, status, percent
+
+
+async def _edit_progress_entry(entry, text):
+    if not await edit_progress_message(entry["chat_id"], entry["message_id"], text):
+        entry["last_text"] = None
+
+
+async def run_progress_scheduler():
+    while progress_messages:
+        await asyncio.sleep(PROGRESS_TICK)
+        now = time.monotonic()
+        progress_scheduler["tokens"] = min(
+            PROGRESS_EDITS_PER_SECOND,
+            progress_scheduler["tokens"] + PROGRESS_EDITS_PER_SECOND * PROGRESS_TICK
+        )
+        if now < progress_scheduler["blocked_until"]:
+            continue
+
+        edits = []
+        chats = set()
+        for entry in sorted(progress_messages.values(), key=lambda e: e["last_edit"]):
+            if progress_scheduler["tokens"] < 1:
+                break
+            if entry["chat_id"] in chats:
+                continue
+            due = _get_due_progress(entry, now)
+            if due is None:
+                continue
+            text, status, percent = due
+            entry.update(last_text=text, last_status=status, last_percent=percent, last_edit=now)
+            progress_scheduler["tokens"] -= 1
+            chats.add(entry["chat_id"])
+            edits.append(_edit_progress_entry(entry, text))
+        if edits:
+            await asyncio.gather(*edits)
+    progress_scheduler["task"] = None
+
+
+def track_progress(chat_id, message_id, job_id):
+    progress_messages[(chat_id, message_id)] = {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "job_id": job_id,
+        "last_text": None,
+        "last_status": None,
+        "last_percent": None,
+        "last_edit": 0.0,
+    }
+    if progress_scheduler["task"] is None:
+        progress_scheduler["task"] = asyncio.create_task(run_progress_scheduler())
+
+
+def stop_progress(chat_id, message_id):
+    progress_messages.pop((chat_id, message_id), None)
+
+
+async def edit_progress_final(chat_id, message_id, text):
+    stop_progress(chat_id, message_id)
+    for _ in range(PROGRESS_FINAL_ATTEMPTS):
+        delay = progress_scheduler["blocked_until"] - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if await edit_progress_message(chat_id, message_id, text):
+            return
 
 
 @bot.message_handler(commands=["start"])
 async def cmd_start(message):
     user = message.from_user
-    register_user(user.id, user.username, user.first_name, user.last_name)
+    register_user(user.id, user.username, user.first_name, user.last_name, deferred=True)
     await safe_send_message(
         message.chat.id,
         "Привет 👋\n\n"
@@ -189,6 +318,117 @@ async def cmd_start(message):
     )
 
 
+@bot.message_handler(commands=["cache"], func=lambda m: m.from_user.id in ADMIN_IDS)
+async def cmd_cache(message):
+    stats = await run_db(get_video_cache_stats)
+    lookups = stats["hits"] + stats["misses"]
+    hit_rate = stats["hits"] / lookups * 100 if lookups else 0
+    resolve = get_resolve_stats()
+    await safe_send_message(
+        message.chat.id,
+        f"Кэш видео:\n\n"
+        f"Записей: {stats['entries']}\n"
+        f"Попаданий с запуска: {stats['hits']}\n"
+        f"Промахов с запуска: {stats['misses']}\n"
+        f"Доля попаданий: {hit_rate:.0f}%\n"
+        f"Попаданий всего: {stats['total_hits']}\n\n"
+        f"Недоступных видео: {stats['negative_entries']}\n"
+        f"Мгновенных отказов с запуска: {stats['negative_hits']}\n\n"
+        f"Коротких ссылок в памяти: {resolve['cached']}\n"
+        f"Раскрыто из кэша: {resolve['hits']}, запросом: {resolve['misses']}, не раскрылось: {resolve['failures']}",
+        reply_markup=get_main_keyboard()
+    )
+
+
+@bot.message_handler(commands=["route"], func=lambda m: m.from_user.id in ADMIN_IDS)
+async def cmd_route(message):
+    stats = get_route_stats()
+    lines = [f"Маршрут Telegram: {stats['route']}", f"Переключений: {stats['switches']}", ""]
+    for mode, route in stats["routes"].items():
+        latency = f"{route['latency'] * 1000:.0f} мс" if route["latency"] is not None else "—"
+        lines.append(
+            f"{mode}: {route['state']}, {latency}, ошибки {route['error_rate'] * 100:.0f}% "
+            f"({route['errors']}/{route['requests']})"
+        )
+    throttle = get_throttle_stats()
+    lines.append(
+        f"\nЗапросов к API: {throttle['calls']}, ожиданий лимита {throttle['throttled']}, "
+        f"ответов 429 {throttle['rate_limited']}"
+    )
+    if is_webhook_enabled():
+        hook = get_webhook_stats()
+        lines.append(
+            f"Webhook: принято {hook['received']}, обработано {hook['processed']}, ошибок {hook['errors']}, "
+            f"без подписи {hook['unauthorized']}, битых {hook['invalid']}, очередь полна {hook['queue_full']}"
+        )
+    await safe_send_message(message.chat.id, "\n".join(lines), reply_markup=get_main_keyboard())
+
+
+@bot.message_handler(commands=["queue"], func=lambda m: m.from_user.id in ADMIN_IDS)
+async def cmd_queue(message):
+    stats = get_download_queue_stats()
+    pending = await run_db(count_queued_jobs)
+    running = stats["running"]
+    lines = [
+        f"Заданий в базе: {pending}",
+        f"Ждут слота: {stats['queued']} из {stats['queue_size']}",
+        f"Качается: {running.get('total', 0)} из {stats['workers']}",
+    ]
+    for platform, name in PLATFORM_NAMES.items():
+        lines.append(f"{name}: {running.get(platform, 0)}, {stats['breakers'].get(platform, 'closed')}")
+    pool = stats["ydl_pool"]
+    lines.append(f"\nyt-dlp: создано {pool['created']}, повторно {pool['reused']}, сброшено {pool['discarded']}")
+    await safe_send_message(message.chat.id, "\n".join(lines), reply_markup=get_main_keyboard())
+
+
+@bot.message_handler(commands=["instagram"], func=lambda m: m.from_user.id in ADMIN_IDS)
+async def cmd_instagram(message):
+    sessions = get_instagram_sessions()
+    if not sessions:
+        await safe_send_message(message.chat.id, "Аккаунты Instagram не настроены.", reply_markup=get_main_keyboard())
+        return
+    lines = ["Аккаунты Instagram:", ""]
+    for session in sessions:
+        lines.append(
+            f"#{session['account']}: {session['state']}, бюджет {session['budget']}, "
+            f"в работе {session['in_use']}, загрузок {session['requests']}, отказов {session['failures']}"
+        )
+    await safe_send_message(message.chat.id, "\n".join(lines), reply_markup=get_main_keyboard())
+
+
+def is_rejected_file_id(error):
+    # Only a 400 about the file itself means the cached file_id is dead; rate limits
+    # and route outages say nothing about it.
+    return error.error_code == 400 and "file" in (error.description or "").lower()
+
+
+async def send_cached_video(message, video_key, cached, url, platform, video_type):
+    try:
+        await safe_send_video(
+            message.chat.id, cached["file_id"],
+            supports_streaming=True,
+            reply_markup=get_description_keyboard(cached["description"])
+        )
+    except ApiTelegramException as e:
+        if not is_rejected_file_id(e):
+            raise
+        logger.warning(f"Cached file_id rejected for {video_key}: {e}")
+        await run_db(invalidate_cached_video, video_key)
+        return False
+
+    logger.info(f"Cache hit: {video_key}")
+    log_download(
+        message.from_user.id, url, platform,
+        video_type=video_type, status="success", file_size=cached["file_size"], video_key=video_key, deferred=True
+    )
+    await safe_send_message(
+        message.chat.id,
+        "Спасибо, что пользуешься мной ❤️",
+        reply_markup=get_main_keyboard()
+    )
+    return True
+
+
 @bot.message_handler(func=lambda m: m.text == "❓ Помощь")
 async def btn_help(message):
     await safe_send_message(
@@ -204,7 +444,7 @@ async def btn_help(message):
 
 @bot.message_handler(func=lambda m: m.text == "📊 Статистика")
 async def btn_stats(message):
-    stats = get_user_stats(message.from_user.id)
+    stats = await run_db_fresh(get_user_stats, message.from_user.id)
     total = stats["total"] or 0
     success = stats["success"] or 0
     yt = stats.get("youtube") or 0
@@ -235,30 +475,18 @@ async def btn_stats(message):
 @bot.callback_query_handler(func=lambda call: call.data.startswith("desc_"))
 async def callback_description(call):
     desc_key = call.data[5:]
-    description = get_description(desc_key)
+    description = await run_db_fresh(pop_description, desc_key)
 
     if description is None:
-        await send_with_fallback(
-            bot.answer_callback_query, call.id, text="Описание больше недоступно."
-        )
+        await safe_answer_callback(call.id, text="Описание больше недоступно.")
         return
 
     if not description:
-        await send_with_fallback(
-            bot.answer_callback_query, call.id, text="У этого видео нет описания."
-        )
-        try:
-            await send_with_fallback(
-                bot.edit_message_reply_markup,
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=None
-            )
-        except Exception:
-            pass
+        await safe_answer_callback(call.id, text="У этого видео нет описания.")
+        await safe_remove_reply_markup(call.message.chat.id, call.message.message_id)
         return
 
-    await send_with_fallback(bot.answer_callback_query, call.id)
+    await safe_answer_callback(call.id)
 
     max_len = 4000
     if len(description) <= max_len:
@@ -276,21 +504,13 @@ async def callback_description(call):
             markup = get_main_keyboard() if i == len(chunks) - 1 else None
             await safe_send_message(call.message.chat.id, chunk, reply_markup=markup)
 
-    try:
-        await send_with_fallback(
-            bot.edit_message_reply_markup,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=None
-        )
-    except Exception:
-        pass
+    await safe_remove_reply_markup(call.message.chat.id, call.message.message_id)
 
 
 @bot.message_handler(func=lambda m: m.text is not None)
 async def handle_message(message):
     user = message.from_user
-    register_user(user.id, user.username, user.first_name, user.last_name)
+    register_user(user.id, user.username, user.first_name, user.last_name, deferred=True)
 
     url = extract_url(message.text)
     if not url:
@@ -311,7 +531,10 @@ async def handle_message(message):
         return
 
     if user.id not in ADMIN_IDS:
-        today_count = get_today_downloads_count(user.id)
+        if is_daily_count_cached():
+            today_count = get_today_downloads_count(user.id)
+        else:
+            today_count = await run_db(get_today_downloads_count, user.id)
         if today_count >= DAILY_LIMIT:
             await safe_send_message(
                 message.chat.id,
@@ -320,99 +543,279 @@ async def handle_message(message):
             )
             return
 
+    canonical = await resolve_url(url)
+    platform, video_type, video_key = canonical["platform"], canonical["video_type"], canonical["video_key"]
+
+    if video_key:
+        cached = await run_db(get_cached_video, video_key)
+        if cached:
+            try:
+                if await send_cached_video(message, video_key, cached, url, platform, video_type):
+                    return
+            except Exception as e:
+                logger.warning(f"Cached send failed for {video_key}: {e}")
+                await safe_send_message(
+                    message.chat.id,
+                    "Не получилось отправить видео, попробуй ещё раз чуть позже.",
+                    reply_markup=get_main_keyboard()
+                )
+                return
+
+        negative = await run_db(get_negative_result, video_key)
+        if negative:
+            logger.info(f"Negative cache hit: {video_key} ({negative['error_class']})")
+            log_download(
+                user.id, url, platform,
+                video_type=video_type, status="error", video_key=video_key, deferred=True
+            )
+            await safe_send_message(message.chat.id, negative["message"], reply_markup=get_main_keyboard())
+            return
+
+    if await run_db(count_queued_jobs) >= DOWNLOAD_QUEUE_SIZE:
+        await safe_send_message(
+            message.chat.id,
+            "Сейчас слишком много загрузок, попробуй через пару минут.",
+            reply_markup=get_main_keyboard()
+        )
+        return
+
     platform_download = {"youtube": "с YouTube", "tiktok": "с TikTok", "instagram": "с Instagram"}
     msg = await safe_send_message(
         message.chat.id,
         f"Скачиваю видео {platform_download.get(platform, platform)}..."
     )
 
-    video_type = detect_video_type(url, platform)
-    download_id = log_download(user.id, url, platform, video_type=video_type)
-
-    done_event = asyncio.Event()
-    progress_task = asyncio.create_task(
-        update_progress(message.chat.id, msg.message_id, user.id, platform, done_event)
+    download_id = await run_db(log_download, user.id, url, platform, video_type=video_type, video_key=video_key)
+    queued_job_id = await run_db(
+        enqueue_download_job, download_id, user.id, message.chat.id, msg.message_id,
+        canonical["url"], platform, video_type, video_key
     )
+    wake_job_runners()
+    track_queued_job(queued_job_id, message.chat.id, msg.message_id)
 
-    filepath, _, _, description, error = await download_video(url, user_id=user.id)
 
-    done_event.set()
+async def process_download_job(job):
+    chat_id, message_id, download_id = job["chat_id"], job["message_id"], job["download_id"]
+    video_key = job["video_key"]
+
+    job_id = create_progress_job(job["platform"])
+    track_progress(chat_id, message_id, job_id)
     try:
-        await progress_task
-    except Exception:
-        pass
+        filepath, _, _, description, error = await download_video(
+            job["url"], job_id=job_id, compress=COMPRESS_OVERSIZED, split=SPLIT_OVERSIZED
+        )
+    finally:
+        stop_progress(chat_id, message_id)
+        finish_progress_job(job_id)
 
     if error:
         cleanup_file(filepath)
-        update_download_status(download_id, "error")
-        await safe_edit_message(error, message.chat.id, msg.message_id)
+        update_download_status(download_id, "error", deferred=True)
+        error_class = get_error_class(error)
+        if video_key and error_class in NEGATIVE_CACHE_TTL:
+            await run_db(save_negative_result, video_key, error_class, error, NEGATIVE_CACHE_TTL[error_class])
+        await edit_progress_final(chat_id, message_id, error)
         return
 
     if not filepath or not os.path.exists(filepath):
-        update_download_status(download_id, "error")
-        await safe_edit_message(
-            "Видео не нашлось 😔",
-            message.chat.id, msg.message_id
-        )
+        update_download_status(download_id, "error", deferred=True)
+        await edit_progress_final(chat_id, message_id, "Видео не нашлось 😔")
         return
 
     file_size = os.path.getsize(filepath)
+    parts = get_video_parts(filepath)
 
-    if file_size > MAX_FILE_SIZE:
+    if file_size > MAX_FILE_SIZE and not parts:
         cleanup_file(filepath)
-        update_download_status(download_id, "error")
+        update_download_status(download_id, "error", deferred=True)
         size_mb = file_size // (1024 * 1024)
-        await safe_edit_message(
-            f"Видео весит {size_mb} МБ, ограничение Telegram — 50 МБ.",
-            message.chat.id, msg.message_id
+        await edit_progress_final(
+            chat_id, message_id,
+            f"Видео весит {size_mb} МБ, ограничение Telegram — {MAX_FILE_SIZE_MB} МБ."
         )
         return
 
     try:
-        desc_key = store_description(description.strip() if description and description.strip() else "")
-        inline_kb = types.InlineKeyboardMarkup()
-        inline_kb.add(types.InlineKeyboardButton("📝 Получить описание", callback_data=f"desc_{desc_key}"))
-
-        with open(filepath, "rb") as video_file:
-            await safe_send_video(
-                message.chat.id, video_file,
-                supports_streaming=True,
-                reply_markup=inline_kb
+        if parts:
+            await send_video_parts(chat_id, parts, description)
+            update_download_status(download_id, "success", file_size, deferred=True)
+        else:
+            with open_video(filepath) as video_file:
+                sent = await safe_send_video(
+                    chat_id, video_file,
+                    supports_streaming=True,
+                    reply_markup=get_description_keyboard(description)
+                )
+            update_download_status(
+                download_id, "success", file_size,
+                compressed=filepath.endswith(COMPRESSED_SUFFIX), deferred=True
             )
-        update_download_status(download_id, "success", file_size)
 
-        await safe_delete_message(message.chat.id, msg.message_id)
+            if video_key and sent and sent.video:
+                await run_db(save_cached_video, video_key, sent.video.file_id, file_size, description)
+
+        await safe_delete_message(chat_id, message_id)
 
         await safe_send_message(
-            message.chat.id,
+            chat_id,
             "Спасибо, что пользуешься мной ❤️",
             reply_markup=get_main_keyboard()
         )
     except Exception:
-        update_download_status(download_id, "error")
-        await safe_edit_message(
-            "Не получилось отправить видео.",
-            message.chat.id, msg.message_id
-        )
+        update_download_status(download_id, "error", deferred=True)
+        await edit_progress_final(chat_id, message_id, "Не получилось отправить видео.")
     finally:
         cleanup_file(filepath)
 
 
-async def main():
-    if not TOKEN:
-        logger.error("TELEGRAM_BOT_TOKEN not set")
-        print("ОШИБКА: Установите TELEGRAM_BOT_TOKEN в Secrets")
+job_runners = {"event": None, "tasks": [], "warmup": None, "lock": None, "leased": {}}
+queued_jobs = {}
+queue_position_updater = {"task": None}
+
+
+def track_queued_job(job_id, chat_id, message_id):
+    queued_jobs[job_id] = {"chat_id": chat_id, "message_id": message_id, "position": None}
+    if queue_position_updater["task"] is None:
+        queue_position_updater["task"] = asyncio.create_task(run_queue_position_updater())
+
+
+async def _edit_queue_position(entry, position):
+    # Once a runner picks the job up its progress scheduler owns the message.
+    if (entry["chat_id"], entry["message_id"]) in progress_messages:
         return
+    entry["position"] = position
+    await edit_progress_message(entry["chat_id"], entry["message_id"], format_queue_position(position))
 
-    mode = await connect_with_fallback(bot)
-    if not mode:
-        logger.error("Could not connect to Telegram API")
-        print("ОШИБКА: Не удалось подключиться к Telegram API")
+
+async def run_queue_position_updater():
+    while queued_jobs:
+        # Sleep first: a job leased right away never shows a position.
+        await asyncio.sleep(PROGRESS_CHAT_INTERVAL)
+        try:
+            positions = await run_db(get_pending_job_positions)
+        except Exception as e:
+            logger.warning(f"Queue positions unavailable: {e}")
+            continue
+        edits = []
+        for job_id, entry in list(queued_jobs.items()):
+            position = positions.get(job_id)
+            if position is None:
+                del queued_jobs[job_id]
+            elif position != entry["position"]:
+                edits.append(_edit_queue_position(entry, position))
+        if edits:
+            await asyncio.gather(*edits)
+    queue_position_updater["task"] = None
+
+
+def wake_job_runners():
+    event = job_runners["event"]
+    if event is not None:
+        event.set()
+
+
+async def wait_for_jobs():
+    event = job_runners["event"]
+    try:
+        await asyncio.wait_for(event.wait(), timeout=JOB_POLL_INTERVAL)
+    except asyncio.TimeoutError:
+        pass
+    event.clear()
+
+
+async def keep_job_lease(job):
+    while True:
+        await asyncio.sleep(JOB_LEASE_TIMEOUT / 3)
+        if not await run_db(extend_job_lease, job["id"], WORKER_ID):
+            logger.warning(f"Lost lease on job {job['id']}")
+            return
+
+
+async def run_leased_job(job):
+    if job["attempts"] > JOB_MAX_ATTEMPTS:
+        logger.error(f"Job {job['id']} dropped after {JOB_MAX_ATTEMPTS} attempts")
+        update_download_status(job["download_id"], "error", deferred=True)
+        await run_db(complete_download_job, job["id"])
+        await edit_progress_final(job["chat_id"], job["message_id"], "Не получилось скачать видео.")
         return
 
-    logger.info(f"Bot started, mode: {mode}")
-    print(f"Бот запущен (режим: {mode})")
+    if job["attempts"] > 1:
+        logger.info(f"Retrying job {job['id']} (attempt {job['attempts']})")
+    heartbeat = asyncio.create_task(keep_job_lease(job))
+    try:
+        await process_download_job(job)
+    except asyncio.CancelledError:
+        await run_db(release_download_job, job["id"], WORKER_ID)
+        raise
+    except Exception as e:
+        logger.error(f"Job {job['id']} failed: {e}")
+        await run_db(release_download_job, job["id"], WORKER_ID)
+        return
+    finally:
+        heartbeat.cancel()
+    await run_db(complete_download_job, job["id"])
+
+
+def get_busy_platforms():
+    leased = job_runners["leased"]
+    return [
+        platform for platform, count in leased.items()
+        if count >= PLATFORM_CONCURRENCY.get(platform, DOWNLOAD_WORKERS)
+    ]
+
+
+async def lease_job():
+    # Platforms at their limit are skipped, so a backlog on one never ties up the runners the others need.
+    async with job_runners["lock"]:
+        job = await run_db(lease_download_job, WORKER_ID, get_busy_platforms())
+        if job is not None:
+            leased = job_runners["leased"]
+            leased[job["platform"]] = leased.get(job["platform"], 0) + 1
+    return job
+
+
+async def run_job_runner():
+    while True:
+        try:
+            job = await lease_job()
+        except Exception as e:
+            logger.error(f"Job lease failed: {e}")
+            job = None
+        if job is None:
+            await wait_for_jobs()
+            continue
+        try:
+            await run_leased_job(job)
+        finally:
+            job_runners["leased"][job["platform"]] -= 1
+            # A freed platform slot may unblock a job that was skipped.
+            wake_job_runners()
+
+
+def start_job_runners():
+    job_runners["event"] = asyncio.Event()
+    job_runners["lock"] = asyncio.Lock()
+    job_runners["tasks"] = [asyncio.create_task(run_job_runner()) for _ in range(JOB_WORKERS)]
+    if not DOWNLOAD_PROCESSES:
+        # Worker processes warm their own pools; in-process downloads get theirs built before the first link.
+        job_runners["warmup"] = asyncio.create_task(asyncio.to_thread(warm_ydl_pool))
+    logger.info(f"Started {JOB_WORKERS} job runners ({WORKER_ID})")
+    return job_runners["tasks"]
+
+
+async def stop_job_runners():
+    tasks = job_runners["tasks"]
+    job_runners["tasks"] = []
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
 
+async def run_polling():
+    try:
+        await send_with_fallback(bot.delete_webhook)
+    except Exception as e:
+        logger.warning(f"delete_webhook failed: {e}")
     while True:
         try:
             await bot.infinity_polling(timeout=60, request_timeout=90)
@@ -427,5 +830,66 @@ async def main():
                 await asyncio.sleep(30)
 
 
+async def run_webhook():
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    server = await start_webhook_server(bot.process_new_updates, secret)
+    try:
+        await send_with_fallback(
+            bot.set_webhook, url=get_webhook_url(), secret_token=secret,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+        logger.info(f"Webhook set: {get_webhook_url()}")
+        await asyncio.Event().wait()
+    finally:
+        await stop_webhook_server(server)
+
+
+async def main(worker=False):
+    if not TOKEN:
+        logger.error("TELEGRAM_BOT_TOKEN not set")
+        print("ОШИБКА: Установите TELEGRAM_BOT_TOKEN в Secrets")
+        return
+
+    # Done here rather than at import: spawned download and compress workers re-import this module.
+    install_route_sessions()
+    # A front-end's in-memory daily counters would miss successes recorded by worker processes.
+    init_db(cache_daily_counts=BOT_MODE != "frontend")
+
+    mode = await connect_with_fallback(bot)
+    if not mode:
+        logger.error("Could not connect to Telegram API")
+        print("ОШИБКА: Не удалось подключиться к Telegram API")
+        return
+
+    logger.info(f"Bot started, mode: {mode}")
+    print(f"Бот запущен (режим: {mode})")
+
+    start_write_behind()
+    prober = asyncio.create_task(run_route_prober())
+    try:
+        if worker:
+            await asyncio.gather(*start_job_runners())
+            return
+        if BOT_MODE != "frontend":
+            # Single-process mode owns every job, so leases left by a previous run can be taken back now.
+            released = await run_db(release_all_leases)
+            if released:
+                logger.info(f"Resuming {released} interrupted downloads")
+            start_job_runners()
+        if is_webhook_enabled():
+            try:
+                await run_webhook()
+            except Exception as e:
+                logger.error(f"Webhook mode failed, falling back to polling: {e}")
+        await run_polling()
+    finally:
+        await stop_job_runners()
+        close_ydl_pool()
+        prober.cancel()
+        await stop_write_behind()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    import sys
+
+    asyncio.run(main(worker=sys.argv[1:] == ["worker"]))
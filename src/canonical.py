@@ -0,0 +1,169 @@
+import os
+import re
+import time
+import asyncio
+import logging
+from urllib.parse import urlsplit, parse_qs
+
+import aiohttp
+
+from downloader import detect_platform, detect_video_type, get_video_key
+
+RESOLVE_TIMEOUT = float(os.getenv("URL_RESOLVE_TIMEOUT", "5"))
+RESOLVE_CACHE_TTL = int(os.getenv("URL_RESOLVE_CACHE_TTL", str(24 * 3600)))
+RESOLVE_CACHE_SIZE = 10000
+
+SHORT_LINK_HOSTS = {"vm.tiktok.com", "vt.tiktok.com"}
+SHORT_LINK_PATHS = {"tiktok.com": ("/t/",), "instagram.com": ("/share/",)}
+YOUTUBE_ID_RE = re.compile(r"^[0-9A-Za-z_-]{11}$")
+YOUTUBE_PATH_RE = re.compile(r"^/(shorts|embed|live|v)/([0-9A-Za-z_-]{11})")
+TIKTOK_PATH_RE = re.compile(r"^/(?:@[^/]+/video|v|embed(?:/v2)?)/(\d+)")
+INSTAGRAM_PATH_RE = re.compile(r"^(?:/[^/]+)?/(p|reels?|tv)/([0-9A-Za-z_-]+)")
+
+logger = logging.getLogger(__name__)
+
+_resolve_cache = {}
+_resolve_session = {"session": None}
+resolve_stats = {"hits": 0, "misses": 0, "failures": 0}
+
+
+def get_resolve_stats():
+    return dict(resolve_stats, cached=len(_resolve_cache))
+
+
+def _split_url(url):
+    if not re.match(r"^https?://", url, re.IGNORECASE):
+        url = "https://" + url
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    for prefix in ("www.", "m.", "music."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    return host, parts.path, parts.query
+
+
+def _canonical(platform, video_id, video_type, url):
+    return {
+        "platform": platform,
+        "video_id": video_id,
+        "video_type": video_type,
+        "video_key": f"{platform}:{video_id}",
+        "url": url,
+    }
+
+
+def canonicalize(url):
+    host, path, query = _split_url(url)
+
+    if host == "youtu.be":
+        video_id = path.strip("/").split("/")[0]
+        if YOUTUBE_ID_RE.match(video_id):
+            return _canonical("youtube", video_id, "youtube", f"https://www.youtube.com/watch?v={video_id}")
+    elif host == "youtube.com" or host == "youtube-nocookie.com":
+        if path == "/watch":
+            video_id = (parse_qs(query).get("v") or [""])[0]
+            if YOUTUBE_ID_RE.match(video_id):
+                return _canonical("youtube", video_id, "youtube", f"https://www.youtube.com/watch?v={video_id}")
+        match = YOUTUBE_PATH_RE.match(path)
+        if match:
+            kind, video_id = match.groups()
+            if kind == "shorts":
+                return _canonical("youtube", video_id, "shorts", f"https://www.youtube.com/shorts/{video_id}")
+            return _canonical("youtube", video_id, "youtube", f"https://www.youtube.com/watch?v={video_id}")
+    elif host == "tiktok.com":
+        match = TIKTOK_PATH_RE.match(path)
+        if match:
+            video_id = match.group(1)
+            return _canonical("tiktok", video_id, "tiktok", f"https://www.tiktok.com{match.group(0)}")
+    elif host in ("instagram.com", "instagr.am"):
+        match = INSTAGRAM_PATH_RE.match(path)
+        if match:
+            kind, shortcode = match.groups()
+            if kind.startswith("reel"):
+                return _canonical("instagram", shortcode, "reels", f"https://www.instagram.com/reel/{shortcode}/")
+            return _canonical("instagram", shortcode, "instagram", f"https://www.instagram.com/{kind}/{shortcode}/")
+    return None
+
+
+def is_short_link(url):
+    host, path, _ = _split_url(url)
+    if host in SHORT_LINK_HOSTS:
+        return True
+    return any(path.startswith(prefix) for prefix in SHORT_LINK_PATHS.get(host, ()))
+
+
+def _fallback(url):
+    platform = detect_platform(url)
+    if not platform:
+        return None
+    video_key = get_video_key(url, platform)
+    video_id = video_key.split(":", 1)[1] if video_key else None
+    return {
+        "platform": platform,
+        "video_id": video_id,
+        "video_type": detect_video_type(url, platform),
+        "video_key": video_key,
+        "url": url,
+    }
+
+
+def _get_cached_resolution(url):
+    entry = _resolve_cache.get(url)
+    if entry is None:
+        return None
+    if entry["expires"] < time.monotonic():
+        del _resolve_cache[url]
+        return None
+    return entry["url"]
+
+
+def _cache_resolution(url, resolved):
+    if len(_resolve_cache) >= RESOLVE_CACHE_SIZE:
+        now = time.monotonic()
+        for key in [k for k, v in _resolve_cache.items() if v["expires"] < now]:
+            del _resolve_cache[key]
+        while len(_resolve_cache) >= RESOLVE_CACHE_SIZE:
+            del _resolve_cache[next(iter(_resolve_cache))]
+    _resolve_cache[url] = {"url": resolved, "expires": time.monotonic() + RESOLVE_CACHE_TTL}
+
+
+def _get_resolve_session():
+    session = _resolve_session["session"]
+    if session is None or session.closed:
+        # Like yt-dlp, link resolution goes out directly; the Telegram proxies are not involved.
+        session = _resolve_session["session"] = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=RESOLVE_TIMEOUT),
+            headers={"User-Agent": "Mozilla/5.0"}
+        )
+    return session
+
+
+async def _follow_redirects(url):
+    if not re.match(r"^https?://", url, re.IGNORECASE):
+        url = "https://" + url
+    async with _get_resolve_session().head(url, allow_redirects=True) as response:
+        return str(response.url)
+
+
+async def resolve_url(url):
+    canonical = canonicalize(url)
+    if canonical:
+        return canonical
+    if not is_short_link(url):
+        return _fallback(url)
+
+    resolved = _get_cached_resolution(url)
+    if resolved is not None:
+        resolve_stats["hits"] += 1
+    else:
+        resolve_stats["misses"] += 1
+        try:
+            resolved = await _follow_redirects(url)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            resolve_stats["failures"] += 1
+            logger.warning(f"Could not resolve {url}: {e!r}")
+            return _fallback(url)
+        _cache_resolution(url, resolved)
+
+    return canonicalize(resolved) or _fallback(url)
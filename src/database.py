@@ -1,17 +1,165 @@
 import sqlite3
 import os
-from datetime import datetime
+import time
+import atexit
+import asyncio
+import functools
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
 DB_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "bot.db")
+VIDEO_CACHE_TTL = int(os.getenv("VIDEO_CACHE_TTL", str(30 * 24 * 3600)))
+
+STATS_VIDEO_TYPES = ("youtube", "shorts", "tiktok", "reels", "instagram")
+
+WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "50"))
+WRITE_FLUSH_INTERVAL = float(os.getenv("DB_WRITE_FLUSH_INTERVAL", "0.5"))
+JOB_LEASE_TIMEOUT = int(os.getenv("JOB_LEASE_TIMEOUT", "300"))
+DESCRIPTION_TTL = 3600
+
+video_cache_counters = {"hits": 0, "misses": 0}
+negative_cache_counters = {"hits": 0}
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+_deferred_download_keys = itertools.count(1)
+_pending_writes = []
+_pending_writes_lock = threading.Lock()
+_write_behind = {"loop": None, "event": None, "task": None}
+_known_users = set()
+_daily_counts = {"warm": False, "day": None, "counts": {}, "downloads": {}}
+_cache_lock = threading.Lock()
 
 
 def get_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.path != DB_PATH:
+        close_connection()
+        conn = sqlite3.connect(DB_PATH, timeout=5)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        _local.conn = conn
+        _local.path = DB_PATH
     return conn
 
 
-def init_db():
+def close_connection():
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
+
+def close_db():
+    _db_executor.submit(close_connection).result()
+    close_connection()
+
+
+def _write(deferred, func, *args):
+    loop = _write_behind["loop"]
+    if deferred and loop is not None:
+        with _pending_writes_lock:
+            _pending_writes.append((func, args))
+            pending = len(_pending_writes)
+        if pending >= WRITE_BATCH_SIZE:
+            loop.call_soon_threadsafe(_write_behind["event"].set)
+        return
+    if _pending_writes:
+        flush_writes()
+    conn = get_connection()
+    result = func(conn.cursor(), *args)
+    conn.commit()
+    return result
+
+
+def flush_writes():
+    with _pending_writes_lock:
+        batch = _pending_writes[:]
+        del _pending_writes[:]
+    if not batch:
+        return 0
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        for func, args in batch:
+            func(cursor, *args)
+        conn.commit()
+        return len(batch)
+    except Exception as e:
+        conn.rollback()
+        logger.warning(f"Batched write failed, retrying {len(batch)} writes one by one: {e}")
+
+    written = 0
+    for func, args in batch:
+        try:
+            func(cursor, *args)
+            conn.commit()
+            written += 1
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Dropped write {func.__name__}{args}: {e}")
+    return written
+
+
+def _call_fresh(func, *args, **kwargs):
+    flush_writes()
+    return func(*args, **kwargs)
+
+
+async def run_db_fresh(func, *args, **kwargs):
+    return await run_db(_call_fresh, func, *args, **kwargs)
+
+
+async def _write_behind_loop():
+    event = _write_behind["event"]
+    while True:
+        try:
+            await asyncio.wait_for(event.wait(), timeout=WRITE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+        if _pending_writes:
+            await run_db(flush_writes)
+
+
+def start_write_behind():
+    if _write_behind["task"] is not None:
+        return
+    _write_behind["loop"] = asyncio.get_event_loop()
+    _write_behind["event"] = asyncio.Event()
+    _write_behind["task"] = asyncio.create_task(_write_behind_loop())
+    atexit.register(flush_writes)
+
+
+async def stop_write_behind():
+    task = _write_behind["task"]
+    if task is None:
+        return
+    _write_behind["loop"] = None
+    _write_behind["task"] = None
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    await run_db(flush_writes)
+
+
+def init_db(cache_daily_counts=True):
     conn = get_connection()
     cursor = conn.cursor()
 
@@ -40,43 +188,184 @@ def init_db():
         )
     """)
 
-    try:
-        cursor.execute("ALTER TABLE downloads ADD COLUMN video_type TEXT")
-        conn.commit()
-    except Exception:
-        pass
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS video_cache (
+            video_key TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            file_size INTEGER,
+            description TEXT,
+            hits INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT (datetime('now')),
+            last_hit_at TEXT
+        )
+    """)
 
     conn.commit()
-    conn.close()
+    migrate(conn)
+    warm_caches(cache_daily_counts)
 
+    purge_expired_video_cache()
+    purge_expired_negative_cache()
 
-def register_user(user_id, username=None, first_name=None, last_name=None):
-    conn = get_connection()
+
+def _column_exists(cursor, table, column):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return any(row["name"] == column for row in cursor.fetchall())
+
+
+def _migration_video_type(cursor):
+    if not _column_exists(cursor, "downloads", "video_type"):
+        cursor.execute("ALTER TABLE downloads ADD COLUMN video_type TEXT")
+
+
+def _migration_download_indexes(cursor):
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_downloads_user_status_created
+        ON downloads (user_id, status, created_at)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_video_cache_created
+        ON video_cache (created_at)
+    """)
+
+
+def _migration_user_stats(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0,
+            success INTEGER NOT NULL DEFAULT 0,
+            errors INTEGER NOT NULL DEFAULT 0,
+            youtube INTEGER NOT NULL DEFAULT 0,
+            shorts INTEGER NOT NULL DEFAULT 0,
+            tiktok INTEGER NOT NULL DEFAULT 0,
+            reels INTEGER NOT NULL DEFAULT 0,
+            instagram INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    _rebuild_user_stats(cursor)
+
+
+def _migration_download_jobs(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS download_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            download_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER,
+            url TEXT NOT NULL,
+            platform TEXT NOT NULL,
+            video_type TEXT,
+            video_key TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_until REAL,
+            created_at TEXT DEFAULT (datetime('now'))
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_download_jobs_status_lease
+        ON download_jobs (status, lease_until)
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS video_descriptions (
+            key TEXT PRIMARY KEY,
+            text TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_video_descriptions_created
+        ON video_descriptions (created_at)
+    """)
+
+
+def _migration_download_video_key(cursor):
+    if not _column_exists(cursor, "downloads", "video_key"):
+        cursor.execute("ALTER TABLE downloads ADD COLUMN video_key TEXT")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_downloads_video_key
+        ON downloads (video_key)
+    """)
+
+
+def _migration_negative_cache(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS negative_cache (
+            video_key TEXT PRIMARY KEY,
+            error_class TEXT NOT NULL,
+            message TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_negative_cache_expires
+        ON negative_cache (expires_at)
+    """)
+
+
+MIGRATIONS = [
+    _migration_video_type,
+    _migration_download_indexes,
+    _migration_user_stats,
+    _migration_download_jobs,
+    _migration_download_video_key,
+    _migration_negative_cache,
+]
+
+
+def migrate(conn):
     cursor = conn.cursor()
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(cursor)
+        cursor.execute(f"PRAGMA user_version = {number}")
+        conn.commit()
+
+
+def _register_user(cursor, user_id, username, first_name, last_name):
     cursor.execute("""
         INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
         VALUES (?, ?, ?, ?)
     """, (user_id, username, first_name, last_name))
-    conn.commit()
-    conn.close()
 
 
-def log_download(user_id, url, platform, video_type=None, status="pending", file_size=None, compressed=False):
-    conn = get_connection()
-    cursor = conn.cursor()
+def register_user(user_id, username=None, first_name=None, last_name=None, deferred=False):
+    with _cache_lock:
+        if user_id in _known_users:
+            return
+        _known_users.add(user_id)
+    _write(deferred, _register_user, user_id, username, first_name, last_name)
+
+
+def _insert_download(cursor, user_id, url, platform, video_type, status, file_size, compressed, video_key):
     cursor.execute("""
-        INSERT INTO downloads (user_id, url, platform, video_type, status, file_size, compressed)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (user_id, url, platform, video_type, status, file_size, 1 if compressed else 0))
-    download_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+        INSERT INTO downloads (user_id, url, platform, video_type, status, file_size, compressed, video_key)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (user_id, url, platform, video_type, status, file_size, 1 if compressed else 0, video_key))
+    _apply_user_stats(cursor, user_id, video_type, status, 1)
+    return cursor.lastrowid
+
+
+def log_download(user_id, url, platform, video_type=None, status="pending", file_size=None, compressed=False,
+                 video_key=None, deferred=False):
+    # Ids come from SQLite so processes sharing the database never hand out the same one. A buffered row
+    # has no id yet and returns None: defer only records that are never updated afterwards.
+    download_id = _write(
+        deferred, _insert_download,
+        user_id, url, platform, video_type, status, file_size, compressed, video_key
+    )
+    _track_download_status(
+        download_id if download_id is not None else ("deferred", next(_deferred_download_keys)), status, user_id
+    )
     return download_id
 
 
-def update_download_status(download_id, status, file_size=None, compressed=False):
-    conn = get_connection()
-    cursor = conn.cursor()
+def _update_download_status(cursor, download_id, status, file_size, compressed):
+    cursor.execute("SELECT user_id, video_type, status FROM downloads WHERE id = ?", (download_id,))
+    previous = cursor.fetchone()
     if file_size is not None:
         cursor.execute("""
             UPDATE downloads SET status = ?, file_size = ?, compressed = ? WHERE id = ?
@@ -85,64 +374,153 @@ def update_download_status(download_id, status, file_size=None, compressed=False
         cursor.execute("""
             UPDATE downloads SET status = ?, compressed = ? WHERE id = ?
         """, (status, 1 if compressed else 0, download_id))
+    if previous and previous["status"] != status:
+        _apply_user_stats(cursor, previous["user_id"], previous["video_type"], previous["status"], -1)
+        _apply_user_stats(cursor, previous["user_id"], previous["video_type"], status, 1)
+
+
+def update_download_status(download_id, status, file_size=None, compressed=False, deferred=False):
+    _track_download_status(download_id, status)
+    _write(deferred, _update_download_status, download_id, status, file_size, compressed)
+
+
+def _apply_user_stats(cursor, user_id, video_type, status, delta):
+    if status not in ("success", "error"):
+        return
+    success = delta if status == "success" else 0
+    errors = delta if status == "error" else 0
+    type_update = ""
+    if status == "success" and video_type in STATS_VIDEO_TYPES:
+        type_update = f", {video_type} = {video_type} + {delta}"
+    cursor.execute("INSERT OR IGNORE INTO user_stats (user_id) VALUES (?)", (user_id,))
+    cursor.execute(f"""
+        UPDATE user_stats SET total = total + ?, success = success + ?, errors = errors + ?{type_update}
+        WHERE user_id = ?
+    """, (delta, success, errors, user_id))
+
+
+def _rebuild_user_stats(cursor):
+    cursor.execute("DELETE FROM user_stats")
+    cursor.execute("""
+        INSERT INTO user_stats (user_id, total, success, errors, youtube, shorts, tiktok, reels, instagram)
+        SELECT
+            user_id,
+            SUM(CASE WHEN status IN ('success', 'error') THEN 1 ELSE 0 END),
+            SUM(CASE WHEN status = 'success' THEN 1 ELSE 0 END),
+            SUM(CASE WHEN status = 'error' THEN 1 ELSE 0 END),
+            SUM(CASE WHEN video_type = 'youtube' AND status = 'success' THEN 1 ELSE 0 END),
+            SUM(CASE WHEN video_type = 'shorts' AND status = 'success' THEN 1 ELSE 0 END),
+            SUM(CASE WHEN video_type = 'tiktok' AND status = 'success' THEN 1 ELSE 0 END),
+            SUM(CASE WHEN video_type = 'reels' AND status = 'success' THEN 1 ELSE 0 END),
+            SUM(CASE WHEN video_type = 'instagram' AND status = 'success' THEN 1 ELSE 0 END)
+        FROM downloads GROUP BY user_id
+    """)
+    return cursor.rowcount
+
+
+def rebuild_user_stats():
+    conn = get_connection()
+    cursor = conn.cursor()
+    rebuilt = _rebuild_user_stats(cursor)
     conn.commit()
-    conn.close()
+    return rebuilt
 
 
 def get_user_downloads_count(user_id):
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT COUNT(*) as cnt FROM downloads
-        WHERE user_id = ? AND status = 'success'
-    """, (user_id,))
+    cursor.execute("SELECT success FROM user_stats WHERE user_id = ?", (user_id,))
     result = cursor.fetchone()
-    conn.close()
-    return result["cnt"] if result else 0
+    return result["success"] if result else 0
 
 
 def get_user_stats(user_id):
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("""
-        SELECT
-            COUNT(*) as total,
-            SUM(CASE WHEN status = 'success' THEN 1 ELSE 0 END) as success,
-            SUM(CASE WHEN status = 'error' THEN 1 ELSE 0 END) as errors
-        FROM downloads WHERE user_id = ?
+        SELECT total, success, errors, youtube, shorts, tiktok, reels, instagram
+        FROM user_stats WHERE user_id = ?
     """, (user_id,))
     result = cursor.fetchone()
-    stats = dict(result) if result else {"total": 0, "success": 0, "errors": 0}
+    if result:
+        return dict(result)
+    stats = {"total": 0, "success": 0, "errors": 0}
+    stats.update({video_type: 0 for video_type in STATS_VIDEO_TYPES})
+    return stats
+
+
+def _utc_today():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
 
+
+def _current_daily_counts():
+    today = _utc_today()
+    if _daily_counts["day"] != today:
+        _daily_counts.update(day=today, counts={}, downloads={})
+    return _daily_counts
+
+
+def warm_caches(cache_daily_counts=True):
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT user_id FROM users")
+    users = {row["user_id"] for row in cursor.fetchall()}
     cursor.execute("""
-        SELECT
-            SUM(CASE WHEN video_type = 'youtube' AND status = 'success' THEN 1 ELSE 0 END) as youtube,
-            SUM(CASE WHEN video_type = 'shorts' AND status = 'success' THEN 1 ELSE 0 END) as shorts,
-            SUM(CASE WHEN video_type = 'tiktok' AND status = 'success' THEN 1 ELSE 0 END) as tiktok,
-            SUM(CASE WHEN video_type = 'reels' AND status = 'success' THEN 1 ELSE 0 END) as reels,
-            SUM(CASE WHEN video_type = 'instagram' AND status = 'success' THEN 1 ELSE 0 END) as instagram
-        FROM downloads WHERE user_id = ?
-    """, (user_id,))
-    platform_result = cursor.fetchone()
-    if platform_result:
-        stats.update(dict(platform_result))
-    else:
-        stats.update({"youtube": 0, "shorts": 0, "tiktok": 0, "reels": 0, "instagram": 0})
+        SELECT id, user_id, status FROM downloads
+        WHERE created_at >= date('now') AND created_at < date('now', '+1 day')
+    """)
+    downloads = {row["id"]: (row["user_id"], row["status"]) for row in cursor.fetchall()}
+    counts = {}
+    for user_id, status in downloads.values():
+        if status == "success":
+            counts[user_id] = counts.get(user_id, 0) + 1
 
-    conn.close()
-    return stats
+    with _cache_lock:
+        _known_users.clear()
+        _known_users.update(users)
+        if cache_daily_counts:
+            _daily_counts.update(warm=True, day=_utc_today(), counts=counts, downloads=downloads)
+        else:
+            _daily_counts.update(warm=False, day=None, counts={}, downloads={})
+
+
+def _track_download_status(download_id, status, user_id=None):
+    with _cache_lock:
+        if not _daily_counts["warm"]:
+            return
+        daily = _current_daily_counts()
+        previous = None
+        if download_id in daily["downloads"]:
+            user_id, previous = daily["downloads"][download_id]
+        elif user_id is None:
+            return
+        if previous == status:
+            return
+        counts = daily["counts"]
+        if previous == "success":
+            counts[user_id] -= 1
+        if status == "success":
+            counts[user_id] = counts.get(user_id, 0) + 1
+        daily["downloads"][download_id] = (user_id, status)
+
+
+def is_daily_count_cached():
+    # While warm, get_today_downloads_count is a dict lookup and safe to call from the event loop.
+    return _daily_counts["warm"]
 
 
 def get_today_downloads_count(user_id):
+    with _cache_lock:
+        if _daily_counts["warm"]:
+            return _current_daily_counts()["counts"].get(user_id, 0)
+
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("""
         SELECT COUNT(*) as cnt FROM downloads
         WHERE user_id = ? AND status = 'success'
-        AND date(created_at) = date('now')
+        AND created_at >= date('now') AND created_at < date('now', '+1 day')
     """, (user_id,))
     result = cursor.fetchone()
-    conn.close()
     return result["cnt"] if result else 0
 
 
@@ -151,5 +529,234 @@ def get_all_users_count():
     cursor = conn.cursor()
     cursor.execute("SELECT COUNT(*) as cnt FROM users")
     result = cursor.fetchone()
-    conn.close()
     return result["cnt"] if result else 0
+
+
+def get_cached_video(video_key):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT video_key, file_id, file_size, description FROM video_cache
+        WHERE video_key = ? AND created_at >= datetime('now', ?)
+    """, (video_key, f"-{VIDEO_CACHE_TTL} seconds"))
+    result = cursor.fetchone()
+    if result:
+        cursor.execute("""
+            UPDATE video_cache SET hits = hits + 1, last_hit_at = datetime('now')
+            WHERE video_key = ?
+        """, (video_key,))
+        conn.commit()
+        video_cache_counters["hits"] += 1
+    else:
+        video_cache_counters["misses"] += 1
+    return dict(result) if result else None
+
+
+def save_cached_video(video_key, file_id, file_size=None, description=None):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT OR REPLACE INTO video_cache (video_key, file_id, file_size, description)
+        VALUES (?, ?, ?, ?)
+    """, (video_key, file_id, file_size, description))
+    conn.commit()
+
+
+def invalidate_cached_video(video_key):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM video_cache WHERE video_key = ?", (video_key,))
+    conn.commit()
+
+
+def purge_expired_video_cache():
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        DELETE FROM video_cache WHERE created_at < datetime('now', ?)
+    """, (f"-{VIDEO_CACHE_TTL} seconds",))
+    removed = cursor.rowcount
+    conn.commit()
+    return removed
+
+
+def get_negative_result(video_key):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT error_class, message FROM negative_cache WHERE video_key = ? AND expires_at > ?
+    """, (video_key, time.time()))
+    result = cursor.fetchone()
+    if result:
+        negative_cache_counters["hits"] += 1
+    return dict(result) if result else None
+
+
+def save_negative_result(video_key, error_class, message, ttl):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT OR REPLACE INTO negative_cache (video_key, error_class, message, expires_at)
+        VALUES (?, ?, ?, ?)
+    """, (video_key, error_class, message, time.time() + ttl))
+    conn.commit()
+
+
+def purge_expired_negative_cache():
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM negative_cache WHERE expires_at <= ?", (time.time(),))
+    removed = cursor.rowcount
+    conn.commit()
+    return removed
+
+
+def get_video_cache_stats():
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT COUNT(*) as entries, COALESCE(SUM(hits), 0) as total_hits FROM video_cache
+    """)
+    result = cursor.fetchone()
+    stats = dict(result) if result else {"entries": 0, "total_hits": 0}
+    stats.update(video_cache_counters)
+    cursor.execute("SELECT COUNT(*) as cnt FROM negative_cache WHERE expires_at > ?", (time.time(),))
+    stats["negative_entries"] = cursor.fetchone()["cnt"]
+    stats["negative_hits"] = negative_cache_counters["hits"]
+    return stats
+
+
+def enqueue_download_job(download_id, user_id, chat_id, message_id, url, platform, video_type=None, video_key=None):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO download_jobs (download_id, user_id, chat_id, message_id, url, platform, video_type, video_key)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (download_id, user_id, chat_id, message_id, url, platform, video_type, video_key))
+    conn.commit()
+    return cursor.lastrowid
+
+
+def count_queued_jobs():
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) as cnt FROM download_jobs WHERE status = 'pending'")
+    result = cursor.fetchone()
+    return result["cnt"] if result else 0
+
+
+def get_pending_job_positions():
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, platform FROM download_jobs WHERE status = 'pending' ORDER BY id")
+    # Runners lease per platform, so a job only waits behind pending jobs of its own platform.
+    positions = {}
+    counts = {}
+    for row in cursor.fetchall():
+        counts[row["platform"]] = counts.get(row["platform"], 0) + 1
+        positions[row["id"]] = counts[row["platform"]]
+    return positions
+
+
+def lease_download_job(owner, skip_platforms=()):
+    now = time.time()
+    platform_filter = ""
+    if skip_platforms:
+        platform_filter = f"AND platform NOT IN ({', '.join('?' * len(skip_platforms))})"
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute(f"""
+            SELECT * FROM download_jobs
+            WHERE (status = 'pending' OR (status = 'leased' AND lease_until < ?)) {platform_filter}
+            ORDER BY id LIMIT 1
+        """, (now, *skip_platforms))
+        row = cursor.fetchone()
+        if row is not None:
+            cursor.execute("""
+                UPDATE download_jobs SET status = 'leased', lease_owner = ?, lease_until = ?, attempts = attempts + 1
+                WHERE id = ?
+            """, (owner, now + JOB_LEASE_TIMEOUT, row["id"]))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if row is None:
+        return None
+    job = dict(row)
+    job.update(status="leased", lease_owner=owner, attempts=job["attempts"] + 1)
+    return job
+
+
+def extend_job_lease(job_id, owner):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE download_jobs SET lease_until = ?
+        WHERE id = ? AND lease_owner = ? AND status = 'leased'
+    """, (time.time() + JOB_LEASE_TIMEOUT, job_id, owner))
+    conn.commit()
+    return cursor.rowcount > 0
+
+
+def release_download_job(job_id, owner):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE download_jobs SET status = 'pending', lease_owner = NULL, lease_until = NULL
+        WHERE id = ? AND lease_owner = ?
+    """, (job_id, owner))
+    conn.commit()
+
+
+def release_all_leases():
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE download_jobs SET status = 'pending', lease_owner = NULL, lease_until = NULL
+        WHERE status = 'leased'
+    """)
+    conn.commit()
+    return cursor.rowcount
+
+
+def _delete_download_job(cursor, job_id):
+    cursor.execute("DELETE FROM download_jobs WHERE id = ?", (job_id,))
+
+
+def complete_download_job(job_id):
+    _write(False, _delete_download_job, job_id)
+
+
+def _save_description(cursor, key, text, created_at):
+    cursor.execute("DELETE FROM video_descriptions WHERE created_at < ?", (created_at - DESCRIPTION_TTL,))
+    cursor.execute("""
+        INSERT OR REPLACE INTO video_descriptions (key, text, created_at) VALUES (?, ?, ?)
+    """, (key, text, created_at))
+
+
+def save_description(key, text, deferred=False):
+    _write(deferred, _save_description, key, text, time.time())
+
+
+def pop_description(key):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT text FROM video_descriptions WHERE key = ? AND created_at >= ?
+    """, (key, time.time() - DESCRIPTION_TTL))
+    result = cursor.fetchone()
+    cursor.execute("DELETE FROM video_descriptions WHERE key = ?", (key,))
+    conn.commit()
+    return result["text"] if result else None
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] == ["rebuild-stats"]:
+        init_db()
+        print(f"Rebuilt stats for {rebuild_user_stats()} users")
+    else:
+        print("Usage: python src/database.py rebuild-stats")
@@ -1,13 +1,125 @@
 import os
 import re
+import glob
+import json
 import asyncio
+import logging
+import multiprocessing
+import subprocess
 import time
+import itertools
+import functools
+import queue
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import yt_dlp
+from yt_dlp.extractor import get_info_extractor
+from yt_dlp.networking.exceptions import HTTPError, TransportError
 
 VIDEOS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "videos")
-MAX_FILE_SIZE = 50 * 1024 * 1024  # 50 MB
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
+CLOUD_FILE_LIMIT_MB = 50
+LOCAL_FILE_LIMIT_MB = 2000
+_file_limit_mb = LOCAL_FILE_LIMIT_MB if TELEGRAM_API_URL else CLOUD_FILE_LIMIT_MB
+MAX_FILE_SIZE_MB = min(int(os.getenv("MAX_FILE_SIZE_MB", str(_file_limit_mb))), _file_limit_mb)
+MAX_FILE_SIZE = MAX_FILE_SIZE_MB * 1024 * 1024
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+DOWNLOAD_QUEUE_SIZE = int(os.getenv("DOWNLOAD_QUEUE_SIZE", "50"))
+YTDL_POOL_SIZE = int(os.getenv("YTDL_POOL_SIZE", str(DOWNLOAD_WORKERS)))
+INSTAGRAM_SESSION_IDS = [
+    session_id.strip()
+    for session_id in os.getenv("INSTAGRAM_SESSION_IDS", os.getenv("INSTAGRAM_SESSION_ID", "")).split(",")
+    if session_id.strip()
+]
+PLATFORM_CONCURRENCY = {
+    "youtube": int(os.getenv("YOUTUBE_CONCURRENCY", "3")),
+    "tiktok": int(os.getenv("TIKTOK_CONCURRENCY", "3")),
+    # Each account runs its own downloads, so throughput scales with the number of sessions.
+    "instagram": int(os.getenv("INSTAGRAM_CONCURRENCY", str(max(1, len(INSTAGRAM_SESSION_IDS))))),
+}
+PLATFORM_MAX_HEIGHT = {"youtube": 720}
+SIZE_HEADROOM = 0.95
+COMPRESS_WORKERS = int(os.getenv("COMPRESS_WORKERS", str(os.cpu_count() or 1)))
+COMPRESS_PASSES = int(os.getenv("COMPRESS_PASSES", "1"))
+COMPRESS_PRESET = os.getenv("COMPRESS_PRESET", "fast")
+COMPRESS_AUDIO_BITRATE = 128_000
+COMPRESS_MIN_VIDEO_BITRATE = 150_000
+COMPRESSED_SUFFIX = "_compressed.mp4"
+REMUX_SUFFIX = "_remux.mp4"
+SPLIT_ATTEMPTS = 3
+PROGRESS_HOOK_INTERVAL = 0.5
+DOWNLOAD_PROCESSES = os.getenv("DOWNLOAD_PROCESSES", "0") == "1"
+DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", "900"))
+DOWNLOAD_DEADLINE = int(os.getenv("DOWNLOAD_DEADLINE", "300"))
+PLATFORM_FAILURE_THRESHOLD = int(os.getenv("PLATFORM_FAILURE_THRESHOLD", "5"))
+PLATFORM_COOLDOWN = int(os.getenv("PLATFORM_COOLDOWN", "120"))
+INSTAGRAM_SESSION_BUDGET = int(os.getenv("INSTAGRAM_SESSION_BUDGET", "60"))
+INSTAGRAM_BUDGET_WINDOW = int(os.getenv("INSTAGRAM_BUDGET_WINDOW", "3600"))
+INSTAGRAM_SESSION_COOLDOWN = int(os.getenv("INSTAGRAM_SESSION_COOLDOWN", "900"))
+INSTAGRAM_MAX_COOLDOWN = 6 * 3600
+PLATFORM_NAMES = {"youtube": "YouTube", "tiktok": "TikTok", "instagram": "Instagram"}
+PROGRESS_JOBS_LIMIT = 1000
+PROGRESS_STALE_AFTER = 2 * 3600
+DOWNLOAD_ERRORS = {
+    "unavailable": "Видео недоступно или удалено.",
+    "private": "Приватное видео, доступ ограничен.",
+    "login": "Для скачивания нужна авторизация.",
+    "geo": "Видео ограничено по региону, скачать не получится.",
+    "timeout": "Скачивание заняло слишком много времени.",
+    "not_found": "Видео не нашлось 😔",
+    "temporary": "Платформа временно не отдаёт видео, попробуй через пару минут.",
+    "platform": "Платформа не ответила, попробуй через пару минут.",
+    "too_long": "Видео качается слишком долго, не успел за отведённое время.",
+}
+# yt-dlp words IP throttling and client blocks like a removed video ("Video unavailable. This content isn't
+# available, try again later."); these markers win over every other pattern and are never cached.
+TEMPORARY_ERROR_MARKERS = ("try again later", "on this app", "temporarily")
+PRIVATE_ERROR_MARKERS = ("private video", "video is private", "account is private")
+LOGIN_ERROR_MARKERS = ("login required", "log in", "login", "sign in", "rate-limit", "rate limit")
+GEO_ERROR_MARKERS = ("in your country", "from your location", "geo restricted", "geo-restricted", "georestricted")
+UNAVAILABLE_ERROR_MARKERS = (
+    "video unavailable", "no longer available", "has been removed", "been deleted", "does not exist"
+)
+INSTAGRAM_SESSIONS_BUSY = "Все аккаунты Instagram сейчас на паузе, попробуй через пару минут."
+# Login walls are per video (YouTube's age gate says "sign in") or per Instagram account, which the
+# session cooldown already handles, so they never open a platform's breaker.
+PLATFORM_FAILURE_CLASSES = {"timeout", "temporary", "platform"}
+NEGATIVE_CACHE_TTL = {
+    "unavailable": int(os.getenv("NEGATIVE_TTL_UNAVAILABLE", str(6 * 3600))),
+    "private": int(os.getenv("NEGATIVE_TTL_PRIVATE", "3600")),
+    "geo": int(os.getenv("NEGATIVE_TTL_GEO", str(24 * 3600))),
+}
+TELEGRAM_VIDEO_CODECS = {"h264"}
+TELEGRAM_AUDIO_CODECS = {"aac"}
+
+logger = logging.getLogger(__name__)
 
 active_progress = {}
+_progress_job_ids = itertools.count(1)
+_inflight_downloads = {}
+_file_refs = {}
+_video_parts = {}
+_download_queue = []
+_running_downloads = {"total": 0}
+_download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="download")
+_compress_executor = None
+_download_workers = None
+_platform_breakers = {}
+_ydl_pools = {}
+_ydl_pools_lock = threading.Lock()
+_instagram_cookie_files = {}
+_instagram_cookie_lock = threading.Lock()
+_instagram_accounts = {}
+ydl_pool_stats = {"created": 0, "reused": 0, "discarded": 0}
+
+
+class DeadlineExceeded(yt_dlp.utils.DownloadCancelled):
+    msg = "Download deadline exceeded"
+
+    def __init__(self, downloading=False):
+        super().__init__()
+        self.downloading = downloading
 
 
 def ensure_videos_dir():
@@ -40,23 +152,81 @@ def detect_video_type(url, platform):
     return platform
 
 
+PLATFORM_EXTRACTORS = {
+    "youtube": ["Youtube"],
+    "tiktok": ["TikTok", "TikTokVM"],
+    "instagram": ["Instagram"],
+}
+
+
+def get_video_key(url, platform):
+    for ie_name in PLATFORM_EXTRACTORS.get(platform, []):
+        video_id = get_info_extractor(ie_name).get_temp_id(url)
+        if video_id:
+            return f"{platform}:{video_id}"
+    return None
+
+
+def _classify_download_error(error_msg):
+    message = error_msg.lower()
+    for error_class, markers in (
+        ("temporary", TEMPORARY_ERROR_MARKERS),
+        ("private", PRIVATE_ERROR_MARKERS),
+        ("login", LOGIN_ERROR_MARKERS),
+        ("geo", GEO_ERROR_MARKERS),
+        ("unavailable", UNAVAILABLE_ERROR_MARKERS),
+    ):
+        if any(marker in message for marker in markers):
+            return error_class
+    return "not_found"
+
+
+def _is_platform_failure(error):
+    # Only failures on the platform's side count; expected extractor errors are the link itself
+    # (unsupported URL, story or profile link, photo post).
+    cause = error.exc_info[1] if error.exc_info else None
+    if isinstance(cause, yt_dlp.utils.ExtractorError):
+        inner = cause.cause or (cause.exc_info[1] if cause.exc_info else None)
+        if not isinstance(inner, (HTTPError, TransportError)):
+            return not cause.expected
+        cause = inner
+    if isinstance(cause, HTTPError):
+        return cause.status >= 500 or cause.status == 429
+    return isinstance(cause, (TransportError, ConnectionError, TimeoutError))
+
+
+def get_error_class(error):
+    for error_class, message in DOWNLOAD_ERRORS.items():
+        if message == error:
+            return error_class
+    return None
+
+
 def extract_url(text):
     url_pattern = r'https?://[^\s<>\"\']+|www\.[^\s<>\"\']+'
     match = re.search(url_pattern, text)
     return match.group(0) if match else None
 
 
-def _get_instagram_cookie_file():
-    session_id = os.getenv("INSTAGRAM_SESSION_ID", "").strip()
-    if not session_id:
+def _get_instagram_cookie_file(account):
+    if account is None or account >= len(INSTAGRAM_SESSION_IDS):
         return None
-    cookie_path = os.path.join(os.path.dirname(__file__), ".ig_cookies.txt")
-    with open(cookie_path, "w") as f:
-        f.write("# Netscape HTTP Cookie File\n")
-        f.write(f".instagram.com\tTRUE\t/\tTRUE\t0\tsessionid\t{session_id}\n")
-        f.write(f".instagram.com\tTRUE\t/\tTRUE\t0\tds_user_id\t0\n")
-        f.write(f".instagram.com\tTRUE\t/\tTRUE\t0\tig_did\t0\n")
-    return cookie_path
+    # The lock keeps the warm-up thread and the first jobs from writing the same file at once; the pid-suffixed
+    # temp file and rename keep worker processes from reading one half-written.
+    with _instagram_cookie_lock:
+        if account in _instagram_cookie_files:
+            return _instagram_cookie_files[account]
+        session_id = INSTAGRAM_SESSION_IDS[account]
+        cookie_path = os.path.join(os.path.dirname(__file__), f".ig_cookies_{account}.txt")
+        tmp_path = f"{cookie_path}.{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            f.write("# Netscape HTTP Cookie File\n")
+            f.write(f".instagram.com\tTRUE\t/\tTRUE\t0\tsessionid\t{session_id}\n")
+            f.write(f".instagram.com\tTRUE\t/\tTRUE\t0\tds_user_id\t0\n")
+            f.write(f".instagram.com\tTRUE\t/\tTRUE\t0\tig_did\t0\n")
+        os.replace(tmp_path, cookie_path)
+        _instagram_cookie_files[account] = cookie_path
+        return cookie_path
 
 
 def _get_base_opts():
@@ -83,7 +253,7 @@ def _get_base_opts():
     }
 
 
-def _get_platform_opts(platform):
+def _get_platform_opts(platform, account=None):
     opts = {}
     if platform == "youtube":
         opts["format"] = "bestvideo[ext=mp4][height<=720]+bestaudio[ext=m4a]/best[ext=mp4][height<=720]/best[height<=720]/best"
@@ -103,15 +273,228 @@ def _get_platform_opts(platform):
             "User-Agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1",
             "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
         }
-        cookie_file = _get_instagram_cookie_file()
+        cookie_file = _get_instagram_cookie_file(account)
         if cookie_file:
             opts["cookiefile"] = cookie_file
     return opts
 
 
-def _make_progress_hook(user_id):
+def _create_ydl(platform, account=None):
+    ydl_opts = _get_base_opts()
+    ydl_opts["outtmpl"] = os.path.join(VIDEOS_DIR, "%(id)s.%(ext)s")
+    ydl_opts.update(_get_platform_opts(platform, account))
+    ydl = yt_dlp.YoutubeDL(ydl_opts)
+    for ie_name in PLATFORM_EXTRACTORS.get(platform, []):
+        ydl.get_info_extractor(ie_name)
+    ydl_pool_stats["created"] += 1
+    return ydl
+
+
+def _close_ydl(ydl):
+    try:
+        ydl.close()
+    except Exception as e:
+        logger.warning(f"Closing yt-dlp instance failed: {e!r}")
+
+
+def _get_ydl_pool(platform, account=None):
+    # Instances carry their account's cookie jar, so each Instagram account gets its own pool.
+    key = (platform, account)
+    with _ydl_pools_lock:
+        if key not in _ydl_pools:
+            # LIFO hands out the most recently used instance, whose connections are the likeliest to be alive.
+            _ydl_pools[key] = queue.LifoQueue(maxsize=YTDL_POOL_SIZE)
+        return _ydl_pools[key]
+
+
+@contextmanager
+def _pooled_ydl(platform, hooks=(), job_params=None, account=None):
+    job_params = job_params or {}
+    pool = _get_ydl_pool(platform, account)
+    try:
+        ydl = pool.get_nowait()
+        ydl_pool_stats["reused"] += 1
+    except queue.Empty:
+        ydl = _create_ydl(platform, account)
+
+    saved = {key: ydl.params.get(key) for key in [*job_params, "format"]}
+    ydl.params.update(job_params)
+    for hook in hooks:
+        ydl.add_progress_hook(hook)
+
+    reusable = False
+    try:
+        yield ydl
+        reusable = True
+    except yt_dlp.utils.DownloadError:
+        reusable = True
+        raise
+    finally:
+        # Undo everything the job changed so the next one starts from the platform defaults.
+        # noinspection PyProtectedMember
+        ydl._progress_hooks.clear()
+        if ydl.params.get("format") != saved["format"]:
+            ydl.format_selector = ydl.build_format_selector(saved["format"])
+        for key, value in saved.items():
+            if value is None:
+                ydl.params.pop(key, None)
+            else:
+                ydl.params[key] = value
+        if reusable:
+            try:
+                pool.put_nowait(ydl)
+                ydl = None
+            except queue.Full:
+                pass
+        if ydl is not None:
+            ydl_pool_stats["discarded"] += 1
+            _close_ydl(ydl)
+
+
+def warm_ydl_pool():
+    for platform in PLATFORM_NAMES:
+        accounts = [None]
+        if platform == "instagram" and INSTAGRAM_SESSION_IDS:
+            accounts = range(len(INSTAGRAM_SESSION_IDS))
+        for account in accounts:
+            pool = _get_ydl_pool(platform, account)
+            if pool.empty():
+                try:
+                    pool.put_nowait(_create_ydl(platform, account))
+                except queue.Full:
+                    pass
+
+
+def close_ydl_pool():
+    with _ydl_pools_lock:
+        pools = list(_ydl_pools.values())
+        _ydl_pools.clear()
+    for pool in pools:
+        while True:
+            try:
+                _close_ydl(pool.get_nowait())
+            except queue.Empty:
+                break
+
+
+def _estimate_format_size(fmt, duration):
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if size:
+        return int(size)
+    tbr = fmt.get("tbr")
+    if tbr and duration:
+        return int(tbr * 1000 / 8 * duration)
+    return None
+
+
+def _estimate_selected_size(info):
+    duration = info.get("duration")
+    total = 0
+    for fmt in info.get("requested_formats") or [info]:
+        size = _estimate_format_size(fmt, duration)
+        if size is None:
+            return None
+        total += size
+    return total
+
+
+def _select_sized_format(info, platform, max_size):
+    duration = info.get("duration")
+    max_height = PLATFORM_MAX_HEIGHT.get(platform)
+    formats = info.get("formats") or []
+
+    audios = []
+    for f in formats:
+        if f.get("vcodec") == "none" and f.get("acodec") not in (None, "none") and f.get("ext") == "m4a":
+            size = _estimate_format_size(f, duration)
+            if size is not None:
+                audios.append((f, size))
+
+    candidates = []
+    for f in formats:
+        if f.get("vcodec") == "none":
+            continue
+        height = f.get("height") or 0
+        if max_height and height > max_height:
+            continue
+        size = _estimate_format_size(f, duration)
+        if size is None:
+            continue
+        is_mp4 = f.get("ext") == "mp4"
+        if f.get("acodec") == "none":
+            if not is_mp4:
+                continue
+            for audio, audio_size in audios:
+                candidates.append((height, is_mp4, size + audio_size, f"{f['format_id']}+{audio['format_id']}"))
+        else:
+            candidates.append((height, is_mp4, size, f["format_id"]))
+
+    budget = max_size * SIZE_HEADROOM
+    fitting = [c for c in candidates if c[2] <= budget]
+    if not fitting:
+        return None, None
+    height, _, size, spec = max(fitting, key=lambda c: (c[0], c[1], c[2]))
+    return spec, size
+
+
+def _apply_size_limit(ydl, info, platform, allow_oversized):
+    estimated = _estimate_selected_size(info)
+    if not estimated or estimated <= MAX_FILE_SIZE * SIZE_HEADROOM:
+        return None
+    spec, _ = _select_sized_format(info, platform, MAX_FILE_SIZE)
+    if spec:
+        ydl.params["format"] = spec
+        ydl.format_selector = ydl.build_format_selector(spec)
+        return None
+    if allow_oversized:
+        return None
+    size_mb = estimated // (1024 * 1024)
+    return f"Видео весит ~{size_mb} МБ, ограничение Telegram — {MAX_FILE_SIZE_MB} МБ."
+
+
+def _new_progress(platform):
+    return {
+        "platform": platform,
+        "status": "pending",
+        "percent": 0,
+        "downloaded": 0,
+        "total": 0,
+        "speed": 0,
+        "eta": 0,
+        "updated_at": time.time(),
+    }
+
+
+def _evict_progress_jobs():
+    now = time.time()
+    stale = [job_id for job_id, p in active_progress.items() if now - p["updated_at"] > PROGRESS_STALE_AFTER]
+    for job_id in stale:
+        del active_progress[job_id]
+    while len(active_progress) >= PROGRESS_JOBS_LIMIT:
+        del active_progress[next(iter(active_progress))]
+
+
+def create_progress_job(platform):
+    _evict_progress_jobs()
+    job_id = next(_progress_job_ids)
+    active_progress[job_id] = _new_progress(platform)
+    return job_id
+
+
+def finish_progress_job(job_id):
+    active_progress.pop(job_id, None)
+
+
+def _make_progress_hook(progress, on_update=None):
+    last_update = [0.0]
+
     def hook(d):
         if d["status"] == "downloading":
+            now = time.time()
+            if now - last_update[0] < PROGRESS_HOOK_INTERVAL:
+                return
+            last_update[0] = now
+
             total = d.get("total_bytes") or d.get("total_bytes_estimate") or 0
             downloaded = d.get("downloaded_bytes", 0)
             speed = d.get("speed") or 0
@@ -122,25 +505,29 @@ def _make_progress_hook(user_id):
             else:
                 percent = 0
 
-            active_progress[user_id] = {
-                "percent": percent,
-                "downloaded": downloaded,
-                "total": total,
-                "speed": speed,
-                "eta": eta,
-                "status": "downloading",
-                "updated_at": time.time(),
-            }
+            progress.update(
+                percent=percent,
+                downloaded=downloaded,
+                total=total,
+                speed=speed,
+                eta=eta,
+                status="downloading",
+                updated_at=now,
+            )
         elif d["status"] == "finished":
-            active_progress[user_id] = {
-                "percent": 100,
-                "downloaded": 0,
-                "total": 0,
-                "speed": 0,
-                "eta": 0,
-                "status": "processing",
-                "updated_at": time.time(),
-            }
+            progress.update(
+                percent=100,
+                downloaded=0,
+                total=0,
+                speed=0,
+                eta=0,
+                status="processing",
+                updated_at=time.time(),
+            )
+        else:
+            return
+        if on_update is not None:
+            on_update(progress)
     return hook
 
 
@@ -179,11 +566,24 @@ def build_progress_bar(percent, width=10):
     return bar
 
 
-def get_progress_text(user_id, platform):
+def get_progress(job_id):
+    return active_progress.get(job_id)
+
+
+def format_queue_position(position):
+    return f"Ты в очереди: {position}-й\nСкачаю, как только освободится место."
+
+
+def get_progress_text(job_id):
     platform_search = {"youtube": "на YouTube", "tiktok": "в TikTok", "instagram": "в Instagram"}
-    p = active_progress.get(user_id)
+    p = active_progress.get(job_id)
     if not p:
-        return f"Ищу видео {platform_search.get(platform, platform)}..."
+        return None
+    if p["status"] == "pending":
+        position = get_queue_position(job_id)
+        if position:
+            return format_queue_position(position)
+        return f"Ищу видео {platform_search.get(p['platform'], p['platform'])}..."
 
     if p["status"] == "processing":
         return f"Почти готово, обрабатываю..."
@@ -203,45 +603,54 @@ def get_progress_text(user_id, platform):
     return "\n".join(lines)
 
 
-video_descriptions = {}
-_desc_counter = 0
-
-
-def store_description(description):
-    global _desc_counter
-    _desc_counter += 1
-    key = str(_desc_counter)
-    now = time.time()
-    expired = [k for k, v in video_descriptions.items() if now - v["ts"] > 3600]
-    for k in expired:
-        del video_descriptions[k]
-    video_descriptions[key] = {"text": description, "ts": now}
-    return key
+def _deadline_opts(deadline):
+    def check_deadline(*args, **kwargs):
+        if time.time() >= deadline:
+            raise DeadlineExceeded()
+        return 0
 
+    def check_progress(d):
+        if time.time() >= deadline:
+            # Bytes still arriving means a long video, not a failing platform.
+            raise DeadlineExceeded(downloading=d.get("status") == "downloading")
 
-def get_description(key):
-    entry = video_descriptions.pop(key, None)
-    if entry:
-        return entry["text"]
-    return None
+    # No socket_timeout clamp: pooled instances fix it when their request handlers are built.
+    return {
+        "retry_sleep_functions": {
+            "http": check_deadline,
+            "fragment": check_deadline,
+            "extractor": check_deadline,
+            "file_access": check_deadline,
+        },
+    }, check_progress
 
 
-def _download_sync(url, platform, user_id=None, compress=False):
+def _download_sync(url, platform, progress=None, allow_oversized=False, hook=None, deadline=None, account=None):
     ensure_videos_dir()
-    output_template = os.path.join(VIDEOS_DIR, "%(id)s.%(ext)s")
+    hooks = []
+    if hook is not None:
+        hooks.append(hook)
+    elif progress is not None:
+        hooks.append(_make_progress_hook(progress))
 
-    ydl_opts = _get_base_opts()
-    ydl_opts["outtmpl"] = output_template
-    ydl_opts.update(_get_platform_opts(platform))
-
-    if user_id:
-        ydl_opts["progress_hooks"] = [_make_progress_hook(user_id)]
+    job_params = {}
+    if deadline is not None:
+        job_params, check_progress = _deadline_opts(deadline)
+        hooks.append(check_progress)
 
     description = None
 
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
+        with _pooled_ydl(platform, hooks, job_params, account) as ydl:
+            info = ydl.extract_info(url, download=False)
+            if info is None:
+                return None, None, "Видео не нашлось 😔"
+
+            size_error = _apply_size_limit(ydl, info, platform, allow_oversized)
+            if size_error:
+                return None, None, size_error
+
+            info = ydl.process_ie_result(info, download=True)
             if info is None:
                 return None, None, "Видео не нашлось 😔"
 
@@ -265,86 +674,692 @@ def _download_sync(url, platform, user_id=None, compress=False):
             if not os.path.exists(filename):
                 return None, None, "Видео не нашлось 😔"
 
-            file_size = os.path.getsize(filename)
-
-            if compress and file_size > MAX_FILE_SIZE:
-                compressed_filename = _compress_sync(input_path=filename)
-                if compressed_filename and os.path.exists(compressed_filename):
-                    os.remove(filename)
-                    compressed_size = os.path.getsize(compressed_filename)
-                    if compressed_size > MAX_FILE_SIZE:
-                        os.remove(compressed_filename)
-                        return None, None, "Видео слишком большое даже после сжатия."
-                    return compressed_filename, description, None
-                else:
-                    return filename, description, "Не получилось сжать видео."
-
+            _remux_if_needed(filename)
             return filename, description, None
 
+    except DeadlineExceeded as e:
+        return None, None, DOWNLOAD_ERRORS["too_long" if e.downloading else "timeout"]
     except yt_dlp.utils.DownloadError as e:
-        error_msg = str(e)
-        if "Video unavailable" in error_msg or "not available" in error_msg:
-            return None, None, "Видео недоступно или удалено."
-        elif "Private video" in error_msg:
-            return None, None, "Приватное видео, доступ ограничен."
-        elif "Login required" in error_msg or "login" in error_msg.lower() or "rate-limit" in error_msg.lower():
-            return None, None, "Для скачивания нужна авторизация."
-        elif "geo" in error_msg.lower() or "country" in error_msg.lower():
-            return None, None, "Видео ограничено по региону, скачать не получится."
-        return None, None, "Видео не нашлось 😔"
+        error_class = _classify_download_error(str(e))
+        if error_class == "not_found" and _is_platform_failure(e):
+            error_class = "platform"
+        return None, None, DOWNLOAD_ERRORS[error_class]
     except Exception:
         return None, None, "Видео не нашлось 😔"
+
+
+def _download_worker_main(conn):
+    # Runs in a spawned process: one request at a time, progress as ("p", ...) tuples, then ("r", ...).
+    def send_progress(p):
+        conn.send(("p", p["status"], p["percent"], p["downloaded"], p["total"], p["speed"], p["eta"]))
+
+    warm_ydl_pool()
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            close_ydl_pool()
+            return
+        if request is None:
+            close_ydl_pool()
+            return
+        url, platform, allow_oversized, deadline, account = request
+        progress = {}
+        hook = _make_progress_hook(progress, send_progress)
+        filepath, description, error = _download_sync(
+            url, platform, progress, allow_oversized, hook, deadline, account
+        )
+        conn.send(("r", filepath, description, error))
+
+
+def _spawn_download_worker():
+    context = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = context.Pipe()
+    process = context.Process(target=_download_worker_main, args=(child_conn,), daemon=True)
+    process.start()
+    child_conn.close()
+    return {"process": process, "conn": parent_conn}
+
+
+def _kill_download_worker(worker):
+    worker["process"].kill()
+    worker["process"].join()
+    worker["conn"].close()
+
+
+def _get_download_workers():
+    global _download_workers
+    if _download_workers is None:
+        _download_workers = queue.Queue()
+        for _ in range(DOWNLOAD_WORKERS):
+            _download_workers.put(None)
+    return _download_workers
+
+
+def _download_in_process(url, platform, progress=None, allow_oversized=False, deadline=None, account=None):
+    workers = _get_download_workers()
+    worker = workers.get()
+    try:
+        if worker is None or not worker["process"].is_alive():
+            worker = _spawn_download_worker()
+        worker["conn"].send((url, platform, allow_oversized, deadline, account))
+        deadline = time.monotonic() + DOWNLOAD_TIMEOUT
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"Download worker {worker['process'].pid} timed out on {url}, killing it")
+                _kill_download_worker(worker)
+                worker = None
+                return None, None, DOWNLOAD_ERRORS["timeout"]
+            if not worker["conn"].poll(min(remaining, 1)):
+                continue
+            message = worker["conn"].recv()
+            if message[0] == "r":
+                return message[1:]
+            if progress is not None:
+                _, status, percent, downloaded, total, speed, eta = message
+                progress.update(
+                    status=status, percent=percent, downloaded=downloaded, total=total,
+                    speed=speed, eta=eta, updated_at=time.time()
+                )
+    except (EOFError, OSError) as e:
+        logger.error(f"Download worker crashed on {url}: {e!r}")
+        if worker is not None:
+            _kill_download_worker(worker)
+        worker = None
+        return None, None, "Не получилось скачать видео."
     finally:
-        if user_id and user_id in active_progress:
-            del active_progress[user_id]
+        workers.put(worker)
+
+
+def _probe_media(path):
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe", "-v", "error",
+                "-show_entries", "format=duration:stream=index,codec_type,codec_name",
+                "-of", "json",
+                path
+            ],
+            capture_output=True, text=True, timeout=30
+        )
+        if result.returncode != 0:
+            return None
+        return json.loads(result.stdout)
+    except Exception:
+        return None
+
+
+def _probe_duration(probe):
+    try:
+        return float(probe["format"]["duration"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _is_telegram_friendly(probe):
+    streams = probe.get("streams") or []
+    video = [st for st in streams if st.get("codec_type") == "video"]
+    audio = [st for st in streams if st.get("codec_type") == "audio"]
+    if not video or video[0].get("codec_name") not in TELEGRAM_VIDEO_CODECS:
+        return False
+    return not audio or audio[0].get("codec_name") in TELEGRAM_AUDIO_CODECS
+
+
+def _has_extra_streams(probe):
+    streams = probe.get("streams") or []
+    video = [st for st in streams if st.get("codec_type") == "video"]
+    audio = [st for st in streams if st.get("codec_type") == "audio"]
+    return len(video) > 1 or len(audio) > 1 or len(streams) > len(video) + len(audio)
+
+
+def _has_faststart(path):
+    try:
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                size = int.from_bytes(header[:4], "big")
+                box = header[4:8]
+                if box == b"moov":
+                    return True
+                if box == b"mdat":
+                    return False
+                if size == 1:
+                    size = int.from_bytes(f.read(8), "big")
+                    f.seek(size - 16, 1)
+                elif size < 8:
+                    return False
+                else:
+                    f.seek(size - 8, 1)
+    except OSError:
+        return False
+
+
+def _remux_sync(input_path, output_path):
+    cmd = [
+        "ffmpeg", "-y", "-i", input_path,
+        "-map", "0:v:0", "-map", "0:a:0?",
+        "-c", "copy",
+        "-movflags", "+faststart",
+        output_path
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, timeout=120)
+        if result.returncode == 0 and os.path.exists(output_path):
+            return output_path
+    except Exception:
+        pass
+    cleanup_file(output_path)
+    return None
+
+
+def _remux_if_needed(filepath):
+    probe = _probe_media(filepath)
+    if not probe or not _is_telegram_friendly(probe):
+        return False
+    if _has_faststart(filepath) and not _has_extra_streams(probe):
+        return False
+
+    remuxed = _remux_sync(filepath, os.path.splitext(filepath)[0] + REMUX_SUFFIX)
+    if not remuxed:
+        return False
+    os.replace(remuxed, filepath)
+    return True
 
 
-def _compress_sync(input_path):
-    import subprocess
-    output_path = input_path.replace(".mp4", "_compressed.mp4")
+def _target_bitrates(duration, max_size):
+    total_bitrate = max_size * 8 * SIZE_HEADROOM / duration
+    audio_bitrate = COMPRESS_AUDIO_BITRATE
+    if total_bitrate - audio_bitrate < COMPRESS_MIN_VIDEO_BITRATE * 2:
+        audio_bitrate = 64_000
+    video_bitrate = int(total_bitrate - audio_bitrate)
+    if video_bitrate < COMPRESS_MIN_VIDEO_BITRATE:
+        return None, None
+    return video_bitrate, audio_bitrate
+
+
+def _compress_sync(input_path, max_size=MAX_FILE_SIZE, passes=COMPRESS_PASSES):
+    output_path = os.path.splitext(input_path)[0] + COMPRESSED_SUFFIX
+    passlog = os.path.splitext(input_path)[0] + "_passlog"
+
+    started = time.time()
+    probe = _probe_media(input_path)
+    duration = _probe_duration(probe)
+    if not duration:
+        return None, None
+
+    if _is_telegram_friendly(probe) and _remux_sync(input_path, output_path):
+        size = os.path.getsize(output_path)
+        if size <= max_size:
+            elapsed = time.time() - started
+            return output_path, {
+                "mode": "remux",
+                "duration": duration,
+                "elapsed": elapsed,
+                "speed": duration / elapsed if elapsed else 0,
+                "size": size,
+                "video_bitrate": None,
+                "passes": 0,
+            }
+        cleanup_file(output_path)
+
+    video_bitrate, audio_bitrate = _target_bitrates(duration, max_size)
+    if not video_bitrate:
+        return None, None
+
+    video_args = [
+        "-c:v", "libx264",
+        "-preset", COMPRESS_PRESET,
+        "-b:v", str(video_bitrate),
+        "-maxrate", str(int(video_bitrate * 1.5)),
+        "-bufsize", str(video_bitrate * 2),
+    ]
+    timeout = max(300, duration * 3)
     try:
+        if passes == 2:
+            cmd = [
+                "ffmpeg", "-y", "-i", input_path,
+                *video_args,
+                "-pass", "1", "-passlogfile", passlog,
+                "-an", "-f", "mp4", os.devnull
+            ]
+            result = subprocess.run(cmd, capture_output=True, timeout=timeout)
+            if result.returncode != 0:
+                return None, None
+            video_args += ["-pass", "2", "-passlogfile", passlog]
+
         cmd = [
-            "ffmpeg", "-i", input_path,
-            "-vcodec", "libx264",
-            "-crf", "28",
-            "-preset", "fast",
-            "-acodec", "aac",
-            "-b:a", "128k",
+            "ffmpeg", "-y", "-i", input_path,
+            *video_args,
+            "-c:a", "aac",
+            "-b:a", str(audio_bitrate),
             "-movflags", "+faststart",
-            "-y",
             output_path
         ]
-        result = subprocess.run(cmd, capture_output=True, timeout=300)
-        if result.returncode == 0 and os.path.exists(output_path):
-            return output_path
-        return None
+        result = subprocess.run(cmd, capture_output=True, timeout=timeout)
+        if result.returncode != 0 or not os.path.exists(output_path):
+            cleanup_file(output_path)
+            return None, None
+
+        elapsed = time.time() - started
+        return output_path, {
+            "mode": "encode",
+            "duration": duration,
+            "elapsed": elapsed,
+            "speed": duration / elapsed if elapsed else 0,
+            "size": os.path.getsize(output_path),
+            "video_bitrate": video_bitrate,
+            "passes": passes,
+        }
     except subprocess.TimeoutExpired:
-        if os.path.exists(output_path):
-            os.remove(output_path)
-        return None
+        cleanup_file(output_path)
+        return None, None
     except Exception:
+        return None, None
+    finally:
+        for f in glob.glob(glob.escape(passlog) + "*"):
+            cleanup_file(f)
+
+
+def _split_sync(input_path, max_size=MAX_FILE_SIZE):
+    base = os.path.splitext(input_path)[0]
+    pattern = base + "_part%03d.mp4"
+    part_glob = glob.escape(base) + "_part*.mp4"
+
+    duration = _probe_duration(_probe_media(input_path))
+    if not duration:
+        return None
+    segment_time = duration * max_size * SIZE_HEADROOM * 0.9 / os.path.getsize(input_path)
+
+    for _ in range(SPLIT_ATTEMPTS):
+        cmd = [
+            "ffmpeg", "-y", "-i", input_path,
+            "-map", "0:v:0", "-map", "0:a:0?",
+            "-c", "copy",
+            "-f", "segment",
+            "-segment_time", f"{segment_time:.2f}",
+            "-reset_timestamps", "1",
+            "-segment_format_options", "movflags=+faststart",
+            pattern
+        ]
+        try:
+            result = subprocess.run(cmd, capture_output=True, timeout=300)
+        except Exception:
+            result = None
+        parts = sorted(glob.glob(part_glob))
+        if result and result.returncode == 0 and parts and all(os.path.getsize(p) <= max_size for p in parts):
+            return parts
+        for part in parts:
+            cleanup_file(part)
+        segment_time *= 0.7
+    return None
+
+
+def _get_compress_executor():
+    global _compress_executor
+    if _compress_executor is None:
+        _compress_executor = ProcessPoolExecutor(
+            max_workers=COMPRESS_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _compress_executor
+
+
+async def _compress_oversized(filepath, description, error):
+    if error or not filepath or not os.path.exists(filepath):
+        return filepath, description, error
+    if os.path.getsize(filepath) <= MAX_FILE_SIZE:
+        return filepath, description, error
+
+    compressed = await compress_video(filepath)
+    if not compressed:
+        return filepath, description, "Не получилось сжать видео."
+    cleanup_file(filepath)
+    if os.path.getsize(compressed) > MAX_FILE_SIZE:
+        cleanup_file(compressed)
+        return None, None, "Видео слишком большое даже после сжатия."
+    return compressed, description, None
+
+
+async def _split_oversized(filepath, description, error):
+    if error or not filepath or not os.path.exists(filepath):
+        return filepath, description, error
+    if os.path.getsize(filepath) <= MAX_FILE_SIZE:
+        return filepath, description, error
+
+    parts = await split_video(filepath)
+    if not parts:
+        return filepath, description, "Не получилось разделить видео на части."
+    _video_parts[filepath] = parts
+    return filepath, description, None
+
+
+def get_video_parts(filepath):
+    return _video_parts.get(filepath)
+
+
+def is_download_queue_full():
+    return len(_download_queue) >= DOWNLOAD_QUEUE_SIZE
+
+
+def get_queue_position(job_id):
+    progress = active_progress.get(job_id)
+    for i, job in enumerate(_download_queue):
+        if progress is not None and job["progress"] is progress:
+            return i + 1
+    return None
+
+
+def get_download_queue_stats():
+    return {
+        "queued": len(_download_queue),
+        "running": dict(_running_downloads),
+        "workers": DOWNLOAD_WORKERS,
+        "queue_size": DOWNLOAD_QUEUE_SIZE,
+        "breakers": get_platform_breakers(),
+        "ydl_pool": dict(ydl_pool_stats),
+    }
+
+
+def _dispatch_downloads():
+    for job in list(_download_queue):
+        if _running_downloads["total"] >= DOWNLOAD_WORKERS:
+            break
+        if job["ready"].done():
+            continue
+        platform = job["platform"]
+        if _running_downloads.get(platform, 0) >= PLATFORM_CONCURRENCY.get(platform, DOWNLOAD_WORKERS):
+            continue
+        _download_queue.remove(job)
+        _running_downloads["total"] += 1
+        _running_downloads[platform] = _running_downloads.get(platform, 0) + 1
+        job["ready"].set_result(True)
+
+
+def _release_download_slot(platform):
+    _running_downloads["total"] -= 1
+    _running_downloads[platform] -= 1
+    _dispatch_downloads()
+
+
+def _enqueue_download(platform, progress):
+    job = {"platform": platform, "progress": progress, "ready": asyncio.get_event_loop().create_future()}
+    _download_queue.append(job)
+    _dispatch_downloads()
+    return job
+
+
+async def _run_download(job, url, platform, compress, split):
+    loop = asyncio.get_event_loop()
+    try:
+        await job["ready"]
+    except asyncio.CancelledError:
+        _get_breaker(platform)["probing"] = False
+        if job in _download_queue:
+            _download_queue.remove(job)
+        else:
+            _release_download_slot(platform)
+        raise
+
+    account = None
+    if platform == "instagram" and INSTAGRAM_SESSION_IDS:
+        account = _acquire_instagram_account()
+        if account is None:
+            # Budgets ran out while the job was queued.
+            _get_breaker(platform)["probing"] = False
+            _release_download_slot(platform)
+            return None, None, INSTAGRAM_SESSIONS_BUSY
+
+    try:
+        download = _download_in_process if DOWNLOAD_PROCESSES else _download_sync
+        deadline = time.time() + DOWNLOAD_DEADLINE
+        result = await loop.run_in_executor(
+            _download_executor, functools.partial(
+                download, url, platform, job["progress"], compress or split, deadline=deadline, account=account
+            )
+        )
+    except BaseException:
+        # Cancellation or a local failure (videos dir, worker spawn) says nothing about the platform,
+        # so a half-open probe is handed to the next job instead of being stranded.
+        _get_breaker(platform)["probing"] = False
+        raise
+    finally:
+        _release_download_slot(platform)
+        if account is not None:
+            _instagram_accounts[account]["in_use"] -= 1
+
+    _record_platform_result(platform, result[2])
+    if account is not None:
+        _record_instagram_result(account, result[2])
+
+    if split:
+        return await _split_oversized(*result)
+    if compress:
+        return await _compress_oversized(*result)
+    return result
+
+
+def _get_breaker(platform):
+    if platform not in _platform_breakers:
+        _platform_breakers[platform] = {"state": "closed", "failures": 0, "opened_at": 0.0, "probing": False}
+    return _platform_breakers[platform]
+
+
+def _platform_available(platform):
+    breaker = _get_breaker(platform)
+    if breaker["state"] == "open":
+        if time.monotonic() - breaker["opened_at"] < PLATFORM_COOLDOWN:
+            return False
+        breaker.update(state="half_open", probing=False)
+    if breaker["state"] == "half_open":
+        # One job goes through as the probe; the rest keep failing fast until it reports back.
+        if breaker["probing"]:
+            return False
+        breaker["probing"] = True
+    return True
+
+
+def _record_platform_result(platform, error):
+    breaker = _get_breaker(platform)
+    if error is not None and get_error_class(error) in PLATFORM_FAILURE_CLASSES:
+        breaker["failures"] += 1
+        if breaker["state"] == "half_open" or breaker["failures"] >= PLATFORM_FAILURE_THRESHOLD:
+            if breaker["state"] != "open":
+                logger.warning(f"{platform} circuit open after {breaker['failures']} failures")
+            breaker.update(state="open", opened_at=time.monotonic(), probing=False)
+        return
+    if breaker["state"] != "closed":
+        logger.info(f"{platform} circuit closed")
+    breaker.update(state="closed", failures=0, probing=False)
+
+
+def get_platform_breakers():
+    return {platform: breaker["state"] for platform, breaker in _platform_breakers.items()}
+
+
+def _get_instagram_account(account):
+    if account not in _instagram_accounts:
+        _instagram_accounts[account] = {
+            "tokens": float(INSTAGRAM_SESSION_BUDGET),
+            "updated": time.monotonic(),
+            "cooldown": INSTAGRAM_SESSION_COOLDOWN,
+            "cooldown_until": 0.0,
+            "in_use": 0,
+            "last_used": 0.0,
+            "requests": 0,
+            "failures": 0,
+        }
+    return _instagram_accounts[account]
+
+
+def _refill_instagram_budget(state, now):
+    rate = INSTAGRAM_SESSION_BUDGET / INSTAGRAM_BUDGET_WINDOW
+    state["tokens"] = min(INSTAGRAM_SESSION_BUDGET, state["tokens"] + (now - state["updated"]) * rate)
+    state["updated"] = now
+
+
+def _ready_instagram_accounts():
+    now = time.monotonic()
+    ready = []
+    for account in range(len(INSTAGRAM_SESSION_IDS)):
+        state = _get_instagram_account(account)
+        _refill_instagram_budget(state, now)
+        if state["cooldown_until"] <= now and state["tokens"] >= 1:
+            ready.append(account)
+    return ready
+
+
+def _instagram_session_available():
+    return not INSTAGRAM_SESSION_IDS or bool(_ready_instagram_accounts())
+
+
+def _acquire_instagram_account():
+    ready = _ready_instagram_accounts()
+    if not ready:
         return None
+    # Least busy first, then least recently used, so jobs rotate across every healthy account.
+    account = min(ready, key=lambda a: (_instagram_accounts[a]["in_use"], _instagram_accounts[a]["last_used"]))
+    state = _instagram_accounts[account]
+    state["tokens"] -= 1
+    state["in_use"] += 1
+    state["requests"] += 1
+    state["last_used"] = time.monotonic()
+    return account
 
 
-async def download_video(url, user_id=None, compress=False):
+def _record_instagram_result(account, error):
+    state = _get_instagram_account(account)
+    if error is None:
+        state["cooldown"] = INSTAGRAM_SESSION_COOLDOWN
+    elif get_error_class(error) == "login":
+        # Login walls and rate limits are per account: bench this one and let the others carry the load.
+        state["failures"] += 1
+        state["cooldown_until"] = time.monotonic() + state["cooldown"]
+        logger.warning(f"Instagram session #{account + 1} cooling down for {state['cooldown']}s")
+        state["cooldown"] = min(state["cooldown"] * 2, INSTAGRAM_MAX_COOLDOWN)
+
+
+def get_instagram_sessions():
+    now = time.monotonic()
+    sessions = []
+    for account in range(len(INSTAGRAM_SESSION_IDS)):
+        state = _get_instagram_account(account)
+        _refill_instagram_budget(state, now)
+        if state["cooldown_until"] > now:
+            status = "cooldown"
+        elif state["tokens"] < 1:
+            status = "exhausted"
+        else:
+            status = "ready"
+        sessions.append({
+            "account": account + 1,
+            "state": status,
+            "budget": int(state["tokens"]),
+            "in_use": state["in_use"],
+            "requests": state["requests"],
+            "failures": state["failures"],
+        })
+    return sessions
+
+
+def _finish_flight(flight_key, task):
+    flight = _inflight_downloads.pop(flight_key, None)
+    if flight is None or task.cancelled() or task.exception():
+        return
+    filepath = task.result()[0]
+    if filepath and flight["waiters"] > 0:
+        _file_refs[filepath] = _file_refs.get(filepath, 0) + flight["waiters"]
+
+
+async def download_video(url, job_id=None, compress=False, split=False):
     platform = detect_platform(url)
     if not platform:
         return None, None, None, None, "Ссылка не распознана."
 
     video_type = detect_video_type(url, platform)
-    loop = asyncio.get_event_loop()
-    filepath, description, error = await loop.run_in_executor(None, _download_sync, url, platform, user_id, compress)
+    flight_key = (get_video_key(url, platform) or url, compress, split)
+
+    flight = _inflight_downloads.get(flight_key)
+    if flight is None:
+        if is_download_queue_full():
+            return None, platform, video_type, None, "Сейчас слишком много загрузок, попробуй через пару минут."
+        # Checked before the breaker: a half-open probe taken here would never report back.
+        if platform == "instagram" and not _instagram_session_available():
+            return None, platform, video_type, None, INSTAGRAM_SESSIONS_BUSY
+        if not _platform_available(platform):
+            return None, platform, video_type, None, (
+                f"{PLATFORM_NAMES.get(platform, platform)} сейчас не отвечает, попробуй через пару минут."
+            )
+        progress = active_progress.get(job_id) or _new_progress(platform)
+        job = _enqueue_download(platform, progress)
+        task = asyncio.ensure_future(_run_download(job, url, platform, compress, split))
+        flight = {"task": task, "waiters": 0, "progress": progress}
+        _inflight_downloads[flight_key] = flight
+        task.add_done_callback(lambda t: _finish_flight(flight_key, t))
+    elif job_id in active_progress:
+        active_progress[job_id] = flight["progress"]
+    flight["waiters"] += 1
+
+    try:
+        filepath, description, error = await asyncio.shield(flight["task"])
+    except asyncio.CancelledError:
+        if flight["task"].done():
+            if not flight["task"].cancelled():
+                cleanup_file(flight["task"].result()[0])
+        else:
+            flight["waiters"] -= 1
+            if flight["waiters"] == 0:
+                flight["task"].cancel()
+        raise
+    except Exception:
+        return None, platform, video_type, None, "Видео не нашлось 😔"
     return filepath, platform, video_type, description, error
 
 
 async def compress_video(input_path):
     loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, _compress_sync, input_path)
+    try:
+        output_path, stats = await loop.run_in_executor(_get_compress_executor(), _compress_sync, input_path)
+    except Exception as e:
+        logger.warning(f"Compression failed for {os.path.basename(input_path)}: {e}")
+        return None
+    if stats and stats["mode"] == "remux":
+        logger.info(
+            f"Remuxed {os.path.basename(input_path)}: {stats['size'] / (1024 * 1024):.1f} MB "
+            f"in {stats['elapsed']:.2f}s, no re-encode"
+        )
+    elif stats:
+        logger.info(
+            f"Compressed {os.path.basename(input_path)}: {stats['size'] / (1024 * 1024):.1f} MB "
+            f"at {stats['video_bitrate'] // 1000} kbit/s, {stats['elapsed']:.1f}s "
+            f"({stats['speed']:.1f}x realtime, {stats['passes']} pass)"
+        )
+    return output_path
 
 
-def cleanup_file(filepath):
+async def split_video(input_path):
+    loop = asyncio.get_event_loop()
     try:
-        if filepath and os.path.exists(filepath):
-            os.remove(filepath)
-    except Exception:
-        pass
+        parts = await loop.run_in_executor(_get_compress_executor(), _split_sync, input_path)
+    except Exception as e:
+        logger.warning(f"Split failed for {os.path.basename(input_path)}: {e}")
+        return None
+    if parts:
+        logger.info(f"Split {os.path.basename(input_path)} into {len(parts)} parts")
+    return parts
+
+
+def cleanup_file(filepath):
+    if filepath in _file_refs:
+        _file_refs[filepath] -= 1
+        if _file_refs[filepath] > 0:
+            return
+        del _file_refs[filepath]
+    for path in [filepath] + _video_parts.pop(filepath, []):
+        try:
+            if path and os.path.exists(path):
+                os.remove(path)
+        except Exception:
+            pass
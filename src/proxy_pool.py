@@ -0,0 +1,258 @@
+import os
+import ssl
+import time
+import logging
+import contextvars
+from contextlib import contextmanager
+
+import aiohttp
+import certifi
+from aiohttp_socks import ProxyConnector
+from telebot import asyncio_helper
+
+SOCKS5_HOST = os.getenv("SOCKS5_HOST", "")
+SOCKS5_PORT = os.getenv("SOCKS5_PORT", "")
+SOCKS5_USERNAME = os.getenv("SOCKS5_USERNAME", "")
+SOCKS5_PASSWORD = os.getenv("SOCKS5_PASSWORD", "")
+MTPROTO_HOST = os.getenv("MTPROTO_HOST", "")
+MTPROTO_PORT = os.getenv("MTPROTO_PORT", "")
+MTPROTO_SECRET = os.getenv("MTPROTO_SECRET", "")
+
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
+
+PROXY_MODE_SOCKS5 = "socks5"
+PROXY_MODE_MTPROTO = "mtproto"
+PROXY_MODE_DIRECT = "direct"
+
+ROUTE_FAILURE_THRESHOLD = int(os.getenv("ROUTE_FAILURE_THRESHOLD", "3"))
+ROUTE_COOLDOWN = float(os.getenv("ROUTE_COOLDOWN", "30"))
+ROUTE_MAX_COOLDOWN = 600
+ROUTE_EWMA_ALPHA = 0.2
+ROUTE_ERROR_PENALTY = 10
+ROUTE_CONNECTION_LIMIT = 50
+
+logger = logging.getLogger(__name__)
+
+_current_route = contextvars.ContextVar("telegram_route", default=None)
+_routes = {}
+route_stats = {"route": None, "switches": 0}
+
+
+def build_socks5_proxy():
+    if not SOCKS5_HOST or not SOCKS5_PORT:
+        return None
+    if SOCKS5_USERNAME and SOCKS5_PASSWORD:
+        return f"socks5://{SOCKS5_USERNAME}:{SOCKS5_PASSWORD}@{SOCKS5_HOST}:{SOCKS5_PORT}"
+    return f"socks5://{SOCKS5_HOST}:{SOCKS5_PORT}"
+
+
+def build_mtproto_proxy():
+    if not MTPROTO_HOST or not MTPROTO_PORT:
+        return None
+    if MTPROTO_SECRET:
+        return f"https://{MTPROTO_HOST}:{MTPROTO_PORT}/{MTPROTO_SECRET}"
+    return f"https://{MTPROTO_HOST}:{MTPROTO_PORT}"
+
+
+def is_local_api():
+    return bool(TELEGRAM_API_URL)
+
+
+def get_proxy_chain():
+    if is_local_api():
+        return [PROXY_MODE_DIRECT]
+    chain = []
+    if build_socks5_proxy():
+        chain.append(PROXY_MODE_SOCKS5)
+    if build_mtproto_proxy():
+        chain.append(PROXY_MODE_MTPROTO)
+    chain.append(PROXY_MODE_DIRECT)
+    return chain
+
+
+def _get_route(mode):
+    if mode not in _routes:
+        _routes[mode] = {
+            "state": "closed",
+            "latency": None,
+            "error_rate": 0.0,
+            "failures": 0,
+            "cooldown": ROUTE_COOLDOWN,
+            "opened_at": 0.0,
+            "probing": False,
+            "requests": 0,
+            "errors": 0,
+        }
+    return _routes[mode]
+
+
+def _refresh_state(route, now):
+    if route["state"] == "open" and now - route["opened_at"] >= route["cooldown"]:
+        route["state"] = "half_open"
+        route["probing"] = False
+
+
+def _score(route):
+    latency = route["latency"] if route["latency"] is not None else 0.0
+    return latency * (1 + route["error_rate"] * ROUTE_ERROR_PENALTY) + route["error_rate"]
+
+
+def select_routes():
+    now = time.monotonic()
+    chain = get_proxy_chain()
+    closed, half_open, opened = [], [], []
+    for priority, mode in enumerate(chain):
+        route = _get_route(mode)
+        _refresh_state(route, now)
+        if route["state"] == "closed":
+            closed.append((_score(route), priority, mode))
+        elif route["state"] == "half_open" and not route["probing"]:
+            half_open.append((priority, mode))
+        else:
+            opened.append((route["opened_at"] + route["cooldown"], mode))
+    ordered = [mode for _, _, mode in sorted(closed)]
+    ordered += [mode for _, mode in sorted(half_open)]
+    if not ordered:
+        # Every circuit is open: try the one that reopens soonest rather than fail outright.
+        ordered = [mode for _, mode in sorted(opened)]
+    _note_best_route(ordered[0])
+    return ordered
+
+
+def _note_best_route(mode):
+    if route_stats["route"] != mode:
+        if route_stats["route"] is not None:
+            route_stats["switches"] += 1
+            logger.info(f"Telegram route: {route_stats['route']} -> {mode}")
+        route_stats["route"] = mode
+
+
+def get_best_route():
+    return select_routes()[0]
+
+
+def get_routes_to_probe():
+    now = time.monotonic()
+    due = []
+    for mode in get_proxy_chain():
+        route = _get_route(mode)
+        _refresh_state(route, now)
+        if route["state"] == "half_open" and not route["probing"]:
+            due.append(mode)
+    return due
+
+
+def record_success(mode, latency):
+    route = _get_route(mode)
+    route["requests"] += 1
+    if route["latency"] is None:
+        route["latency"] = latency
+    else:
+        route["latency"] += ROUTE_EWMA_ALPHA * (latency - route["latency"])
+    route["error_rate"] *= 1 - ROUTE_EWMA_ALPHA
+    route["failures"] = 0
+    route["probing"] = False
+    if route["state"] != "closed":
+        logger.info(f"Route {mode} recovered")
+        route["state"] = "closed"
+        route["cooldown"] = ROUTE_COOLDOWN
+
+
+def record_failure(mode):
+    route = _get_route(mode)
+    route["requests"] += 1
+    route["errors"] += 1
+    route["error_rate"] += ROUTE_EWMA_ALPHA * (1 - route["error_rate"])
+    route["failures"] += 1
+    route["probing"] = False
+    if route["state"] == "half_open":
+        route["cooldown"] = min(route["cooldown"] * 2, ROUTE_MAX_COOLDOWN)
+        _open(mode, route)
+    elif route["state"] == "closed" and route["failures"] >= ROUTE_FAILURE_THRESHOLD:
+        _open(mode, route)
+
+
+def _open(mode, route):
+    route["state"] = "open"
+    route["opened_at"] = time.monotonic()
+    logger.warning(f"Route {mode} circuit open for {route['cooldown']:.0f}s")
+
+
+@contextmanager
+def use_route(mode):
+    route = _get_route(mode)
+    probing = route["state"] == "half_open"
+    if probing:
+        route["probing"] = True
+    token = _current_route.set(mode)
+    try:
+        yield
+    finally:
+        _current_route.reset(token)
+        if probing:
+            # A cancelled probe records neither outcome; free the slot so the route can be probed again.
+            route["probing"] = False
+
+
+def get_route_stats():
+    now = time.monotonic()
+    routes = {}
+    for mode in get_proxy_chain():
+        route = _get_route(mode)
+        _refresh_state(route, now)
+        routes[mode] = {
+            "state": route["state"],
+            "latency": route["latency"],
+            "error_rate": route["error_rate"],
+            "requests": route["requests"],
+            "errors": route["errors"],
+        }
+    return {"route": get_best_route(), "switches": route_stats["switches"], "routes": routes}
+
+
+class RouteSessionManager:
+    def __init__(self):
+        self.ssl_context = ssl.create_default_context(cafile=certifi.where())
+        self.sessions = {}
+
+    @property
+    def session(self):
+        # AsyncTeleBot.close_session() closes `session_manager.session`; close every route's pool.
+        return self
+
+    def _create_session(self, mode):
+        if mode == PROXY_MODE_SOCKS5:
+            connector = ProxyConnector.from_url(
+                build_socks5_proxy(), limit=ROUTE_CONNECTION_LIMIT, ssl=self.ssl_context
+            )
+            return aiohttp.ClientSession(connector=connector)
+        connector = aiohttp.TCPConnector(limit=ROUTE_CONNECTION_LIMIT, ssl=self.ssl_context)
+        if mode == PROXY_MODE_MTPROTO:
+            return aiohttp.ClientSession(connector=connector, proxy=build_mtproto_proxy())
+        return aiohttp.ClientSession(connector=connector)
+
+    async def get_session(self):
+        mode = _current_route.get() or get_best_route()
+        session = self.sessions.get(mode)
+        # noinspection PyProtectedMember
+        if session is not None and not session.closed and not session._loop.is_running():
+            await session.close()
+            session = None
+        if session is None or session.closed:
+            session = self.sessions[mode] = self._create_session(mode)
+        return session
+
+    async def close(self):
+        for session in self.sessions.values():
+            if not session.closed:
+                await session.close()
+        self.sessions.clear()
+
+
+def install_route_sessions():
+    if is_local_api():
+        asyncio_helper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+        asyncio_helper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+    asyncio_helper.proxy = None
+    asyncio_helper.session_manager = RouteSessionManager()
+    return asyncio_helper.session_manager
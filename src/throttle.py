@@ -0,0 +1,107 @@
+import os
+import time
+import asyncio
+import logging
+from telebot.asyncio_helper import ApiTelegramException
+
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+GLOBAL_BURST = float(os.getenv("TELEGRAM_GLOBAL_BURST", "30"))
+CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+CHAT_BUCKET_IDLE = 300
+
+LANE_CONCURRENCY = {
+    "upload": int(os.getenv("TELEGRAM_UPLOAD_CONCURRENCY", "4")),
+    "message": int(os.getenv("TELEGRAM_MESSAGE_CONCURRENCY", "20")),
+    "edit": int(os.getenv("TELEGRAM_EDIT_CONCURRENCY", "10")),
+}
+LANE_RETRIES = {"upload": 3, "message": 3, "edit": 0}
+
+logger = logging.getLogger(__name__)
+
+_buckets = {}
+_blocked_until = {}
+_lanes = {}
+throttle_stats = {"calls": 0, "throttled": 0, "rate_limited": 0}
+
+
+def get_throttle_stats():
+    return dict(throttle_stats)
+
+
+def get_retry_after(error):
+    if isinstance(error, ApiTelegramException) and error.error_code == 429:
+        parameters = (error.result_json or {}).get("parameters") or {}
+        return parameters.get("retry_after", 1)
+    return None
+
+
+def _get_lane(lane):
+    if lane not in _lanes:
+        _lanes[lane] = asyncio.Semaphore(LANE_CONCURRENCY.get(lane, 1))
+    return _lanes[lane]
+
+
+def _evict_idle_buckets(now):
+    idle = [key for key, b in _buckets.items() if key != "global" and now - b["updated"] > CHAT_BUCKET_IDLE]
+    for key in idle:
+        del _buckets[key]
+        _blocked_until.pop(key, None)
+
+
+async def _take_token(key, rate, burst):
+    while True:
+        now = time.monotonic()
+        blocked = _blocked_until.get(key, 0) - now
+        if blocked > 0:
+            throttle_stats["throttled"] += 1
+            await asyncio.sleep(blocked)
+            continue
+
+        bucket = _buckets.get(key)
+        if bucket is None:
+            if len(_buckets) > 1000:
+                _evict_idle_buckets(now)
+            bucket = _buckets[key] = {"tokens": burst, "updated": now}
+        bucket["tokens"] = min(burst, bucket["tokens"] + (now - bucket["updated"]) * rate)
+        bucket["updated"] = now
+        if bucket["tokens"] >= 1:
+            bucket["tokens"] -= 1
+            return
+        throttle_stats["throttled"] += 1
+        await asyncio.sleep((1 - bucket["tokens"]) / rate)
+
+
+def block(chat_id, seconds):
+    key = ("chat", chat_id) if chat_id is not None else "global"
+    _blocked_until[key] = max(_blocked_until.get(key, 0), time.monotonic() + seconds)
+
+
+def rewind_files(args, kwargs):
+    for value in list(args) + list(kwargs.values()):
+        if hasattr(value, "seek"):
+            value.seek(0)
+
+
+async def schedule(lane, chat_id, func, *args, **kwargs):
+    retries = LANE_RETRIES.get(lane, 0)
+    for attempt in range(retries + 1):
+        # A chat's own pacing or 429 block is waited out before taking a lane slot,
+        # so a throttled chat cannot hold a slot every other chat needs.
+        if chat_id is not None:
+            await _take_token(("chat", chat_id), CHAT_RATE, CHAT_BURST)
+        async with _get_lane(lane):
+            await _take_token("global", GLOBAL_RATE, GLOBAL_BURST)
+            throttle_stats["calls"] += 1
+            try:
+                return await func(*args, **kwargs)
+            except ApiTelegramException as e:
+                retry_after = get_retry_after(e)
+                if retry_after is None:
+                    raise
+                throttle_stats["rate_limited"] += 1
+                block(chat_id, retry_after)
+                logger.warning(f"429 in {lane} lane (chat {chat_id}), retry after {retry_after}s")
+                if attempt == retries:
+                    raise
+        rewind_files(args, kwargs)
@@ -0,0 +1,91 @@
+import os
+import hmac
+import asyncio
+import logging
+from aiohttp import web
+from telebot import types
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "64"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+logger = logging.getLogger(__name__)
+
+webhook_stats = {"received": 0, "unauthorized": 0, "invalid": 0, "queue_full": 0, "processed": 0, "errors": 0}
+
+
+def is_webhook_enabled():
+    return bool(WEBHOOK_URL)
+
+
+def get_webhook_url():
+    return WEBHOOK_URL + WEBHOOK_PATH
+
+
+def get_webhook_stats():
+    return dict(webhook_stats)
+
+
+def _make_handler(queue, secret):
+    async def handle_update(request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            webhook_stats["unauthorized"] += 1
+            return web.Response(status=403)
+        try:
+            update = types.Update.de_json(await request.text())
+        except Exception as e:
+            webhook_stats["invalid"] += 1
+            logger.warning(f"Invalid webhook payload: {e}")
+            return web.Response(status=400)
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Non-2xx makes Telegram redeliver the update later instead of us dropping it.
+            webhook_stats["queue_full"] += 1
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        webhook_stats["received"] += 1
+        return web.Response()
+
+    return handle_update
+
+
+async def _update_worker(queue, process_updates):
+    while True:
+        update = await queue.get()
+        try:
+            await process_updates([update])
+            webhook_stats["processed"] += 1
+        except Exception as e:
+            webhook_stats["errors"] += 1
+            logger.error(f"Webhook update {update.update_id} failed: {e}")
+        finally:
+            queue.task_done()
+
+
+async def start_webhook_server(process_updates, secret):
+    queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, _make_handler(queue, secret))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    except Exception:
+        await runner.cleanup()
+        raise
+    workers = [asyncio.create_task(_update_worker(queue, process_updates)) for _ in range(WEBHOOK_WORKERS)]
+    logger.info(f"Webhook server on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, {WEBHOOK_WORKERS} workers")
+    return {"runner": runner, "workers": workers, "queue": queue}
+
+
+async def stop_webhook_server(server):
+    await server["runner"].cleanup()
+    for worker in server["workers"]:
+        worker.cancel()
+    await asyncio.gather(*server["workers"], return_exceptions=True)